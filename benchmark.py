@@ -0,0 +1,425 @@
+## Offline Benchmarks
+
+"""
+Drives scripted sessions through the compiled Idiomatic graph with deterministic local stand-ins
+for Gemini, so routing, caching and persistence regressions show up without network access:
+
+    python benchmark.py --sessions 10 --turns 200 --latency 0.05 --failure-rate 0.05
+
+The fake chat model and GenAI client sleep for a configurable latency and can inject 429/503
+errors (and malformed or truncated questions, with `--malformed-rate`), which the shared model-call governor throttles and retries exactly as it does for the
+real clients (with millisecond backoff, so injected failures don't dominate). Sessions run
+concurrently through the server-mode `SessionManager`, all in one temporary working directory,
+so the stores start empty and real user data is never touched. The script mixes quiz answers
+with commands the fast path handles and requests the tool-bound fake chat model answers with
+tool calls, so both routes to the tools are measured. The report covers per-node latency,
+turns per second, model calls per question, memory growth and checkpoint volume per turn over
+the run; `--json` prints it in machine-readable form.
+`--check-checkpoints` also reads back every checkpoint and pending write as it is saved, and
+exits with status 1 if any differs, a session keeps more than CHECKPOINT_KEEP checkpoints or a
+stored message is left unreferenced.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import defaultdict
+
+import httpx
+from google.genai import errors, types
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+
+import idiomatic
+
+
+## Fake Gemini Backends
+
+FAKE_IDIOMS = [
+    "bite the bullet", "go belly up", "circle the wagons", "break the ice", "spill the beans",
+    "hit the hay", "under the weather", "piece of cake", "cost an arm and a leg", "let the cat out of the bag",
+    "throw in the towel", "take the high road", "shoot from the hip", "pull someone's leg", "once in a blue moon",
+    "the ball is in your court", "burn the midnight oil", "cut corners", "hit the nail on the head", "jump the gun",
+]
+
+def fake_word(rng: random.Random) -> str:
+    return "".join(rng.choice("bcdfglmnprstvz") + rng.choice("aeiou") for _ in range(3))
+
+def fake_quiz_item(rng: random.Random, index: int) -> dict:
+    idiom = FAKE_IDIOMS[index % len(FAKE_IDIOMS)]
+    if index >= len(FAKE_IDIOMS):
+        # Made-up idioms keep long runs distinct, "<idiom> #2" would be caught as a near-duplicate
+        idiom = f"{fake_word(rng)} the {fake_word(rng)}"
+    options = ["to give up", "to act rashly", "to stay calm", idiom]
+    rng.shuffle(options)
+    letters = "abcd"
+    question = f"Q. Which option is an idiom?\n" + "".join(f" {letter}. {option}\n" for letter, option in zip(letters, options))
+    return {"idiom": idiom, "question": question, "answer": letters[options.index(idiom)]}
+
+class FakeBackend:
+    """Shared latency, failure injection and call counting for the fakes"""
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0, failure_codes=(429, 503), seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failure_codes = failure_codes
+        self.calls = 0
+        self.failures = 0
+        self.tool_calls = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def call(self):
+        """Count a call, sleep for its latency and possibly raise an injected API error"""
+        with self._lock:
+            self.calls += 1
+            delay = max(self.latency + self._rng.uniform(-self.jitter, self.jitter), 0.0)
+            fail = self._rng.random() < self.failure_rate
+            code = self._rng.choice(self.failure_codes)
+            if fail:
+                self.failures += 1
+        time.sleep(delay)
+        if fail:
+            error_class = errors.ClientError if code < 500 else errors.ServerError
+            raise error_class(code, httpx.Response(code, json={"error": {"code": code, "message": "injected", "status": "INJECTED"}}))
+
+class FakeResponse:
+    def __init__(self, text: str, prompt_tokens=None):
+        self.text = text
+        self.usage_metadata = None
+        if prompt_tokens is not None:
+            self.usage_metadata = types.GenerateContentResponseUsageMetadata(prompt_token_count=prompt_tokens)
+
+def fake_tokens(text: str) -> int:
+    return len(text) // 4
+
+class FakeModels:
+    def __init__(self, backend: FakeBackend, malformed_rate=0.0):
+        self.backend = backend
+        self.malformed_rate = malformed_rate  # fraction of items given a wrong answer letter or cut short
+        self._rng = random.Random(1)
+        self._index = 0
+        self._lock = threading.Lock()
+
+    def _next_item(self) -> dict:
+        with self._lock:
+            self._index += 1
+            item = fake_quiz_item(self._rng, self._index)
+            if self._rng.random() < self.malformed_rate:
+                item["answer"] = "e"
+            return item
+
+    def _truncate(self, text: str) -> str:
+        with self._lock:
+            if self._rng.random() < self.malformed_rate:
+                return text[:self._rng.randrange(len(text) // 2, len(text))]
+        return text
+
+    def generate_content(self, model=None, contents=None, config=None):
+        self.backend.call()
+        usage = {"prompt_tokens": fake_tokens(contents)}
+        if "list" in str(getattr(config, "response_schema", "")):
+            items = [self._next_item() for _ in range(idiomatic.GENERATE_QnA_BATCH_SIZE)]
+            return FakeResponse(self._truncate(json.dumps(items)), **usage)
+        return FakeResponse(self._truncate(json.dumps(self._next_item())), **usage)
+
+class FakeGenaiClient:
+    """Stands in for genai.Client, only `models.generate_content` is used"""
+
+    def __init__(self, backend: FakeBackend, malformed_rate=0.0):
+        self.models = FakeModels(backend, malformed_rate)
+
+# Requests the fast-path rules leave to the orchestration LLM, which the tool-bound fake answers with a
+# tool call: (tool, pattern on the learner's message, arguments from the match and the system prompt)
+FAKE_TOOL_REQUESTS = [
+    ("show_score", re.compile(r"how many points"), lambda match, system: {"score": int(re.search(r"Current Score: (\d+)", system)[1])}),
+    ("lookup_idiom", re.compile(r"i need an idiom for (.+)"), lambda match, system: {"query": match[1]}),
+    ("explain_last_question", re.compile(r"tell me more about that one"),
+     lambda match, system: {"idiom": re.search(r"Last Question Idiom: (.+)\.", system)[1]}),
+]
+
+class FakeChatModel:
+    """Stands in for ChatGoogleGenerativeAI (and its tool-bound version, which calls tools for FAKE_TOOL_REQUESTS)"""
+
+    def __init__(self, backend: FakeBackend, tools=False):
+        self.backend = backend
+        self.tools = tools
+
+    def bind_tools(self, tools):
+        return FakeChatModel(self.backend, tools=True)
+
+    def invoke(self, messages, *args, **kwargs):
+        self.backend.call()
+        last = messages[-1]
+        if self.tools and isinstance(last, HumanMessage):
+            for tool_name, pattern, arguments in FAKE_TOOL_REQUESTS:
+                if match := pattern.search(last.content.lower()):
+                    with self.backend._lock:
+                        self.backend.tool_calls += 1
+                    call = {"name": tool_name, "args": arguments(match, messages[0].content), "id": f"call_{uuid.uuid4().hex}"}
+                    return AIMessage(content="", tool_calls=[call])
+        return AIMessage(content=f"Here's a friendly reply to: {last.content[:40]}")
+
+    def stream(self, messages, *args, **kwargs):
+        message = self.invoke(messages)
+        for word in message.content.split(" "):
+            yield AIMessageChunk(content=word + " ")
+
+
+## Measurement
+
+class NodeTimer(BaseCallbackHandler):
+    """Times every graph node run via LangChain callbacks"""
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self._started = {}
+        self._lock = threading.Lock()
+
+    def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        if node and kwargs.get("name") == node and not node.startswith("__"):
+            with self._lock:
+                self._started[run_id] = (node, time.perf_counter())
+
+    def _finish(self, run_id):
+        with self._lock:
+            started = self._started.pop(run_id, None)
+            if started:
+                self.durations[started[0]].append(time.perf_counter() - started[1])
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._finish(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        # Nodes waiting on input end with an interrupt, the time up to that point still counts
+        self._finish(run_id)
+
+def comparable(checkpoint: dict) -> dict:
+    # LangGraph sometimes leaves a channel holding None out of channel_values while its version still
+    # points at the None it saved earlier, which every saver (the in-memory one too) reads back as None
+    values = {channel: value for channel, value in checkpoint["channel_values"].items() if value is not None}
+    return {**checkpoint, "channel_values": values}
+
+class CheckedCheckpointer(idiomatic.SqliteCheckpointer):
+    """Reads every checkpoint and write back right after saving it (`--check-checkpoints`), recording
+    any difference, a session holding more than `keep` checkpoints and stored messages nothing uses"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checks = 0
+        self.mismatches = []
+
+    def _expect(self, ok: bool, what: str):
+        self.checks += 1
+        if not ok:
+            self.mismatches.append(what)
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        saved = super().put(config, checkpoint, metadata, new_versions)
+        stored = self.get_tuple(saved)
+        thread = saved["configurable"]["thread_id"]
+        expected_metadata = {
+            key: value for key, value in idiomatic.get_checkpoint_metadata(config, metadata).items() if key != "writes"
+        }
+        self._expect(stored is not None and comparable(stored.checkpoint) == comparable(checkpoint), f"{thread}: checkpoint {checkpoint['id']}")
+        self._expect(stored is not None and stored.metadata == expected_metadata, f"{thread}: metadata {checkpoint['id']}")
+        self._expect(
+            (stored.parent_config or {}).get("configurable", {}).get("checkpoint_id") == config["configurable"].get("checkpoint_id"),
+            f"{thread}: parent of {checkpoint['id']}",
+        )
+        listed = list(self.list({"configurable": {"thread_id": thread, "checkpoint_ns": saved["configurable"]["checkpoint_ns"]}}))
+        self._expect(len(listed) <= self.keep and comparable(listed[0].checkpoint) == comparable(checkpoint), f"{thread}: {len(listed)} checkpoints listed")
+        with self._lock:
+            referenced = set()
+            for (digests,) in self._conn.execute("SELECT value FROM blobs WHERE thread_id = ? AND type = 'items'", (thread,)):
+                referenced.update(json.loads(digests))
+            stored_items = {digest for (digest,) in self._conn.execute("SELECT digest FROM items WHERE thread_id = ?", (thread,))}
+        self._expect(referenced == stored_items, f"{thread}: {len(stored_items - referenced)} unreferenced, "
+                                                 f"{len(referenced - stored_items)} missing messages")
+        return saved
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        super().put_writes(config, writes, task_id, task_path)
+        pending = self.get_tuple(config).pending_writes
+        for channel, value in writes:
+            # msgpack hands tuples back as lists, compare with what the serializer itself returns
+            value = self.serde.loads_typed(self.serde.dumps_typed(value))
+            self._expect((task_id, channel, value) in pending, f"{config['configurable']['thread_id']}: write to {channel}")
+
+    def stats(self) -> dict:
+        return {**super().stats(), "checks": self.checks, "mismatches": len(self.mismatches), "examples": self.mismatches[:3]}
+
+SCRIPT = [
+    "b", "a", "score", "c", "explain", "d", "what does break the ice mean?", "a", "tell me something fun", "b",
+    # These reach the tools through the orchestration LLM rather than the fast path
+    "how many points have I got?", "c", "I need an idiom for being nervous", "tell me more about that one",
+]
+
+def session_inputs(index: int, turns: int) -> list[str]:
+    """Setup answers, then `turns` scripted answers/commands, then quit"""
+    return [f"learner{index}", "b", "general"] + [SCRIPT[turn % len(SCRIPT)] for turn in range(turns)] + ["quit"]
+
+async def run_session(manager, index: int, turns: int, memory_samples: list, checkpoint_samples: list):
+    response = await manager.start()
+    for turn, text in enumerate(session_inputs(index, turns)):
+        if response["finished"]:
+            break
+        response = await manager.send(response["session_id"], text)
+        if index == 0 and turn % 50 == 0:
+            memory_samples.append(tracemalloc.get_traced_memory()[0])
+            checkpoint_samples.append(idiomatic.get_checkpointer().bytes_written)
+    return response["finished"]
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+async def run_benchmark(sessions=5, turns=100, latency=0.0, jitter=0.0, failure_rate=0.0, seed=0,
+                        rate_limit=0.0, max_concurrency=idiomatic.MODEL_MAX_CONCURRENCY, malformed_rate=0.0,
+                        check_checkpoints=False) -> dict:
+    backend = FakeBackend(latency, jitter, failure_rate, seed=seed)
+    idiomatic.set_models(llm=FakeChatModel(backend), client=FakeGenaiClient(backend, malformed_rate))
+    idiomatic.get_governor.override(idiomatic.ModelCallGovernor(
+        rate=rate_limit, max_concurrency=max_concurrency, backoff_base=0.001, backoff_max=0.01
+    ))
+    idiomatic.set_output_sink(idiomatic.BufferSink())
+    idiomatic.metrics.reset()
+    timer = NodeTimer()
+    idiomatic.get_checkpointer.override((CheckedCheckpointer if check_checkpoints else idiomatic.SqliteCheckpointer)("sessions.db"))
+    manager = idiomatic.SessionManager(idiomatic.build_graph(checkpointer=idiomatic.get_checkpointer()), callbacks=[timer])
+
+    tracemalloc.start()
+    memory_samples = [tracemalloc.get_traced_memory()[0]]
+    checkpoint_samples = []  # bytes checkpointed so far, every 50 turns of the first session
+    started = time.perf_counter()
+    finished = await asyncio.gather(*(run_session(manager, index, turns, memory_samples, checkpoint_samples) for index in range(sessions)))
+    elapsed = time.perf_counter() - started
+    memory_samples.append(tracemalloc.get_traced_memory()[0])
+    tracemalloc.stop()
+
+    questions = len(timer.durations["generate_question"])
+    generated = idiomatic.quiz_item_stats()["generated"]
+    generation_tokens = lambda direction: sum(
+        idiomatic.metrics.value("idiomatic_model_tokens_total", kind=kind, direction=direction)
+        for kind in ("generate_question", "generate_batch")
+    )
+    total_turns = sessions * (turns + 4)
+    return {
+        "sessions": sessions,
+        "turns_per_session": turns,
+        "completed_sessions": sum(finished),
+        "elapsed_s": round(elapsed, 3),
+        "turns_per_s": round(total_turns / elapsed, 1),
+        "questions": questions,
+        "model_calls": backend.calls,
+        "llm_tool_calls": backend.tool_calls,
+        "injected_failures": backend.failures,
+        "retries": int(idiomatic.metrics.value("idiomatic_model_retries_total")),
+        "shed_calls": int(idiomatic.metrics.value("idiomatic_model_shed_total")),
+        "routes": {
+            dict(labels)["route"]: int(value)
+            for (name, labels), value in sorted(idiomatic.metrics.counters.items()) if name == "idiomatic_routes_total"
+        },
+        "model_calls_per_question": round(backend.calls / questions, 3) if questions else None,
+        "nodes": {
+            node: {
+                "runs": len(durations),
+                "mean_ms": round(1000 * statistics.mean(durations), 3),
+                "p50_ms": round(1000 * percentile(durations, 0.5), 3),
+                "p95_ms": round(1000 * percentile(durations, 0.95), 3),
+            }
+            for node, durations in sorted(timer.durations.items())
+        },
+        "memory_start_kb": round(memory_samples[0] / 1024, 1),
+        "memory_end_kb": round(memory_samples[-1] / 1024, 1),
+        "memory_growth_kb_per_100_turns": round((memory_samples[-1] - memory_samples[0]) / 1024 / max(total_turns / 100, 1), 1),
+        "checkpoint_kb_per_turn": round(idiomatic.get_checkpointer().bytes_written / 1024 / total_turns, 2),
+        # Written per turn (across all sessions) early in the run and at its end, these should match
+        "checkpoint_kb_per_turn_first_last": [
+            round((later - earlier) / 1024 / (50 * sessions), 2)
+            for earlier, later in (checkpoint_samples[:2], checkpoint_samples[-2:])
+        ] if len(checkpoint_samples) > 2 else None,
+        "question_pool": idiomatic.get_question_pool().stats(),
+        "response_cache": idiomatic.get_response_cache().stats(),
+        "model_governor": idiomatic.get_governor().stats(),
+        "question_validation": idiomatic.quiz_item_stats(),
+        "prompt_tokens_per_generated_question": round(generation_tokens("prompt") / generated, 1) if generated else None,
+        "checkpoint_round_trips": idiomatic.get_checkpointer().stats() if check_checkpoints else None,
+    }
+
+def print_report(report: dict):
+    print(f"\n{report['completed_sessions']}/{report['sessions']} sessions x {report['turns_per_session']} turns "
+          f"in {report['elapsed_s']}s ({report['turns_per_s']} turns/s)")
+    print(f"{report['questions']} questions, {report['model_calls']} model calls "
+          f"({report['model_calls_per_question']} per question), "
+          f"{report['injected_failures']} injected failures, {report['retries']} retries, "
+          f"{report['shed_calls']} shed, {report['llm_tool_calls']} tool calls from the LLM")
+    print(f"routes: {report['routes']}")
+    print(f"memory {report['memory_start_kb']} -> {report['memory_end_kb']} KiB "
+          f"({report['memory_growth_kb_per_100_turns']} KiB per 100 turns)")
+    print(f"checkpoints {report['checkpoint_kb_per_turn']} KiB per turn "
+          f"(first/last 50 turns: {report['checkpoint_kb_per_turn_first_last']})")
+    print(f"\n{'node':<20}{'runs':>8}{'mean ms':>12}{'p50 ms':>12}{'p95 ms':>12}")
+    for node, stats in report["nodes"].items():
+        print(f"{node:<20}{stats['runs']:>8}{stats['mean_ms']:>12}{stats['p50_ms']:>12}{stats['p95_ms']:>12}")
+    print(f"\nquestion pool: {report['question_pool']}")
+    print(f"response cache: {report['response_cache']}")
+    print(f"model governor: {report['model_governor']}")
+    print(f"question validation: {report['question_validation']}")
+    print(f"prompt tokens per generated question: {report['prompt_tokens_per_generated_question']}")
+    if report["checkpoint_round_trips"]:
+        print(f"checkpoint round trips: {report['checkpoint_round_trips']}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Idiomatic graph against fake Gemini backends")
+    parser.add_argument("--sessions", type=int, default=5, help="concurrent scripted sessions")
+    parser.add_argument("--turns", type=int, default=100, help="scripted turns per session")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per fake model call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="+/- seconds of random latency")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of model calls failing with 429/503")
+    parser.add_argument("--malformed-rate", type=float, default=0.0,
+                        help="fraction of generated questions with a bad answer letter or truncated JSON")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="model calls per second, 0 for unlimited")
+    parser.add_argument("--max-concurrency", type=int, default=idiomatic.MODEL_MAX_CONCURRENCY,
+                        help="upper bound of the adaptive model-call concurrency limit")
+    parser.add_argument("--check-checkpoints", action="store_true",
+                        help="read back every checkpoint and write as it is saved (slower, exits 1 on a mismatch)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    # Keep the benchmark's stores away from real user data
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            report = asyncio.run(run_benchmark(
+                args.sessions, args.turns, args.latency, args.jitter, args.failure_rate, args.seed,
+                args.rate_limit, args.max_concurrency, args.malformed_rate,
+                args.check_checkpoints,
+            ))
+        finally:
+            idiomatic.shutdown_services()
+            os.chdir(cwd)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    if report["checkpoint_round_trips"] and report["checkpoint_round_trips"]["mismatches"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,84 +1,934 @@
 ## Imports 
 
+import argparse
+import asyncio
+import bisect
+import functools
+import hashlib
+import heapq
 import json
+import logging
+import operator
 import random
+import sys
 import os
-from datetime import datetime
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from array import array
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager, suppress
+from contextvars import ContextVar
+from datetime import datetime, timezone
 from dataclasses import dataclass
+from itertools import compress, repeat
 from typing import Annotated, Literal
 from typing_extensions import TypedDict
-from IPython.display import Markdown, display
+
+try:
+    import fcntl  # POSIX only, lets several processes append to one answer log
+except ImportError:
+    fcntl = None
 
 from langgraph.graph import StateGraph, END
 from langgraph.graph.message import add_messages
-from langchain_core.messages import SystemMessage, HumanMessage, AIMessage, ToolMessage
+from langgraph.types import Command, interrupt
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.base import BaseCheckpointSaver, CheckpointTuple, WRITES_IDX_MAP, get_checkpoint_id, get_checkpoint_metadata
+from langgraph.errors import GraphInterrupt
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage, ToolMessage, RemoveMessage, message_chunk_to_message
 from langchain_core.tools import tool
+from langchain_core.runnables import Runnable
 from langgraph.prebuilt import ToolNode
-from langchain_google_genai import ChatGoogleGenerativeAI
 
 from google import genai
 from google.genai import types
-from google.api_core import retry
 
 
+## Shared Services
+
+"""
+Importing this module has no side effects: model clients, stores and the compiled graph are
+created by `shared` factories on first use, and the interactive session only starts from
+`main()`. Workers and tests therefore only pay for what they touch, and every session in a
+process reuses the same clients and compiled graph. `set_models` swaps in other model clients
+(e.g. stubs) before or after they are first used.
+"""
+
+def shared(factory):
+    """Decorator: build the factory's result on first call and hand the same instance to every caller"""
+    lock = threading.Lock()
+    instance = []
+
+    @functools.wraps(factory)
+    def get():
+        if not instance:
+            with lock:
+                if not instance:
+                    instance.append(factory())
+        return instance[0]
+
+    def override(value):
+        with lock:
+            instance[:] = [value]
+
+    get.created = lambda: bool(instance)
+    get.override = override
+    get.reset = instance.clear
+    return get
+
+
+
+## Instrumentation
+
+"""
+Debug output goes through the `idiomatic` logger: `IDIOMATIC_DEBUG=1` prints the familiar
+"--- Routing ... ---" trail, and with it off the calls cost next to nothing. Node runs, model
+calls, retries, token counts, routing decisions and cache lookups are recorded in `metrics`, a
+small Prometheus-style registry of counters and histograms (served at `/metrics` in server mode,
+or written to `IDIOMATIC_METRICS_FILE` on shutdown). Timed operations are also spans; set
+`IDIOMATIC_TRACE_FILE` to export them as OpenTelemetry-style JSON lines.
+"""
+
+logger = logging.getLogger("idiomatic")
+
+TRACE_FILE = os.getenv('IDIOMATIC_TRACE_FILE', '')
+METRICS_FILE = os.getenv('IDIOMATIC_METRICS_FILE', '')
+
+def configure_logging(debug: bool):
+    """Print debug messages in the "--- message ---" style on stdout, or silence them"""
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("--- %(message)s ---"))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(logging.DEBUG if debug else logging.INFO)
+
+class Metrics:
+    """Thread-safe counters and histograms, rendered in the Prometheus text format"""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(float)  # (name, labels) -> value
+        self.histograms = {}                # (name, labels) -> [bucket counts, sum, count]
+
+    def inc(self, name: str, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] += amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.setdefault(key, [[0] * len(self.BUCKETS), 0.0, 0])
+            for index, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def value(self, name: str, **labels) -> float:
+        """Sum of a counter over every label set matching `labels`"""
+        with self._lock:
+            return sum(
+                value for (counter, counter_labels), value in self.counters.items()
+                if counter == name and labels.items() <= dict(counter_labels).items()
+            )
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    @staticmethod
+    def _labels(labels, **extra) -> str:
+        pairs = list(labels) + list(extra.items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{key}="{str(value)}"'.replace("\n", " ") for key, value in pairs) + "}"
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append(f"{name}{self._labels(labels)} {value:g}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (histogram, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                    if histogram != name:
+                        continue
+                    for bound, bucket_count in zip(self.BUCKETS, buckets):
+                        lines.append(f"{name}_bucket{self._labels(labels, le=f'{bound:g}')} {bucket_count}")
+                    lines.append(f"{name}_bucket{self._labels(labels, le='+Inf')} {count}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {total:g}")
+                    lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class SpanExporter:
+    """Appends finished spans to a file as OpenTelemetry-style JSON lines"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, "a")
+
+    def export(self, record: dict):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            if self._file.closed:  # a background refill finishing after shutdown
+                return
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+current_span = ContextVar("idiomatic_span", default=None)
+
+@contextmanager
+def span(name: str, metric=None, **attributes):
+    """Time a block as a span, optionally observing its duration in a histogram labelled with `attributes`.
+    Yields a dict of extra span attributes the block may fill in."""
+    exporter = get_span_exporter()
+    extra = {}
+    parent = current_span.get()
+    record = None
+    if exporter is not None:
+        record = {
+            "name": name,
+            "trace_id": parent["trace_id"] if parent else uuid.uuid4().hex,
+            "span_id": uuid.uuid4().hex[:16],
+            "parent_span_id": parent["span_id"] if parent else None,
+            "start_time_unix_nano": time.time_ns(),
+        }
+        token = current_span.set(record)
+    status = "OK"
+    started = time.perf_counter()
+    try:
+        yield extra
+    except GraphInterrupt:
+        status = "INTERRUPTED"
+        raise
+    except BaseException as e:
+        status = "ERROR"
+        extra["exception.type"] = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        if metric:
+            metrics.observe(metric, duration, **attributes)
+        if record is not None:
+            current_span.reset(token)
+            record.update(end_time_unix_nano=time.time_ns(), status=status, attributes={**attributes, **extra})
+            exporter.export(record)
+
+def instrumented_node(name: str, node):
+    """Wrap a graph node so every run is timed, counted and traced"""
+    if isinstance(node, Runnable):
+        def run(state, config):
+            with span(f"node {name}", metric="idiomatic_node_seconds", node=name):
+                return node.invoke(state, config)
+    else:
+        def run(state):
+            with span(f"node {name}", metric="idiomatic_node_seconds", node=name):
+                return node(state)
+    run.__name__ = name
+    return run
+
+def record_tokens(kind: str, response, attributes: dict):
+    """Count prompt/output tokens from a GenAI response or a LangChain message"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    if isinstance(usage, dict):  # LangChain messages
+        prompt_tokens, output_tokens = usage.get("input_tokens"), usage.get("output_tokens")
+    else:
+        prompt_tokens, output_tokens = usage.prompt_token_count, usage.candidates_token_count
+    # Prompt tokens served from implicit prompt caching (included in the prompt count, billed at a discount)
+    cached_tokens = getattr(usage, "cached_content_token_count", None)
+    for direction, count in (("prompt", prompt_tokens), ("cached", cached_tokens), ("output", output_tokens)):
+        if count:
+            metrics.inc("idiomatic_model_tokens_total", count, kind=kind, direction=direction)
+            attributes[f"tokens.{direction}"] = count
+
+def model_call(kind: str, call, *args, priority: str = "interactive", **kwargs):
+    """Run a model call through the rate limiter, recording its latency, outcome and token usage"""
+    with span(f"model {kind}", metric="idiomatic_model_call_seconds", kind=kind) as attributes:
+        try:
+            response = get_governor().call(call, *args, priority=priority, **kwargs)
+        except ModelUnavailable:
+            metrics.inc("idiomatic_model_calls_total", kind=kind, status="shed")
+            raise
+        except Exception:
+            metrics.inc("idiomatic_model_calls_total", kind=kind, status="error")
+            raise
+        metrics.inc("idiomatic_model_calls_total", kind=kind, status="ok")
+        record_tokens(kind, response, attributes)
+        return response
+
+def model_stream(kind: str, stream, *args, priority: str = "interactive", **kwargs):
+    """Like `model_call` for a streaming call: yields chunks as they arrive, also recording time to first token"""
+    with span(f"model {kind}", metric="idiomatic_model_call_seconds", kind=kind, streaming=True) as attributes:
+        started = time.perf_counter()
+        message = None
+        try:
+            for chunk in get_governor().stream(stream, *args, priority=priority, **kwargs):
+                if message is None:
+                    metrics.observe("idiomatic_model_first_token_seconds", time.perf_counter() - started, kind=kind)
+                message = chunk if message is None else message + chunk
+                yield chunk
+        except ModelUnavailable:
+            metrics.inc("idiomatic_model_calls_total", kind=kind, status="shed")
+            raise
+        except Exception:
+            metrics.inc("idiomatic_model_calls_total", kind=kind, status="error")
+            raise
+        metrics.inc("idiomatic_model_calls_total", kind=kind, status="ok")
+        record_tokens(kind, message, attributes)
+
+def record_retry(error):
+    """`on_error` hook for retried model calls"""
+    code = getattr(error, "code", "unknown")
+    metrics.inc("idiomatic_model_retries_total", code=code)
+    logger.debug("Retrying model call after %s", code)
+
+@shared
+def get_span_exporter():
+    return SpanExporter(TRACE_FILE) if TRACE_FILE else None
+
+## Rate Limiting
+
+"""
+Every model call, through the GenAI client or the LangChain chat model, is admitted by one shared
+`ModelCallGovernor` instead of retrying blindly on its own. A token bucket caps the request rate
+and an AIMD limit caps concurrency: a throttled response (429/503) halves the limit, each success
+grows it back by 1/limit. Throttled calls are retried with full-jitter exponential backoff.
+Interactive calls (a user is waiting) are admitted ahead of background prefetch, and a call that
+can't get a slot in time raises `ModelUnavailable` so the caller can degrade gracefully.
+"""
+
+MODEL_RATE_LIMIT = float(os.getenv('IDIOMATIC_RATE_LIMIT', 10))           # calls per second, 0 disables the bucket
+MODEL_RATE_BURST = int(os.getenv('IDIOMATIC_RATE_BURST', 10))
+MODEL_MAX_CONCURRENCY = int(os.getenv('IDIOMATIC_MAX_CONCURRENCY', 8))
+MODEL_MAX_RETRIES = int(os.getenv('IDIOMATIC_MAX_RETRIES', 3))           # per call, after throttling
+MODEL_BACKOFF_BASE = 0.5                                                 # seconds
+MODEL_BACKOFF_MAX = 8.0
+MODEL_DECREASE_INTERVAL = 1.0  # seconds between limit cuts, so one burst of 429s counts once
+
+INTERACTIVE, BACKGROUND = "interactive", "background"
+MODEL_MAX_WAIT = {  # seconds a call may queue for a slot before it is shed
+    INTERACTIVE: float(os.getenv('IDIOMATIC_INTERACTIVE_WAIT', 10)),
+    BACKGROUND: float(os.getenv('IDIOMATIC_BACKGROUND_WAIT', 60)),
+}
+
+class ModelUnavailable(Exception):
+    """A model call was shed: no slot freed up in time, or the API kept throttling"""
+
+def is_retriable(e) -> bool:
+    """Rate limits and unavailability, from the GenAI SDK or google.api_core (LangChain)"""
+    return isinstance(e, Exception) and getattr(e, "code", None) in {429, 503}
+
+class ModelCallGovernor:
+    """Token bucket + AIMD concurrency limit shared by every model call, interactive calls first"""
+
+    def __init__(self, rate=MODEL_RATE_LIMIT, burst=MODEL_RATE_BURST, max_concurrency=MODEL_MAX_CONCURRENCY,
+                 max_retries=MODEL_MAX_RETRIES, max_wait=MODEL_MAX_WAIT,
+                 backoff_base=MODEL_BACKOFF_BASE, backoff_max=MODEL_BACKOFF_MAX):
+        self.rate, self.burst = rate, max(1, burst)
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.backoff_base, self.backoff_max = backoff_base, backoff_max
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self.waiting = {INTERACTIVE: 0, BACKGROUND: 0}
+        self.counts = defaultdict(int)  # admitted, throttled, retried, shed
+        self._tokens = float(self.burst)
+        self._refilled = time.monotonic()
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def _refill(self, now: float):
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def acquire(self, priority: str = INTERACTIVE):
+        """Block until a concurrency slot and a rate token are free, or raise ModelUnavailable"""
+        deadline = time.monotonic() + self.max_wait[priority]
+        with self._cond:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    yielding = priority == BACKGROUND and self.waiting[INTERACTIVE]
+                    has_token = self.rate <= 0 or self._tokens >= 1
+                    if not yielding and has_token and self.in_flight < int(self.limit):
+                        if self.rate > 0:
+                            self._tokens -= 1
+                        self.in_flight += 1
+                        self.counts["admitted"] += 1
+                        return
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self.counts["shed"] += 1
+                        metrics.inc("idiomatic_model_shed_total", priority=priority, reason="queue")
+                        raise ModelUnavailable(f"no model capacity for a {priority} call")
+                    if not has_token:
+                        remaining = min(remaining, (1 - self._tokens) / self.rate)
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting[priority] -= 1
+                self._cond.notify_all()  # background calls may have been yielding to this one
+
+    def release(self, throttled: bool = False):
+        """Free a slot, adjusting the concurrency limit: multiplicative decrease, additive increase"""
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.counts["throttled"] += 1
+                if now - self._last_decrease >= MODEL_DECREASE_INTERVAL:
+                    self.limit = max(1.0, self.limit / 2)
+                    self._last_decrease = now
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def _admit(self, priority: str):
+        started = time.perf_counter()
+        self.acquire(priority)
+        metrics.observe("idiomatic_model_queue_seconds", time.perf_counter() - started, priority=priority)
+
+    def _failed(self, error: Exception, attempt: int, priority: str):
+        """Release the slot of a failed attempt, then re-raise, shed or back off before the next one"""
+        throttled = is_retriable(error)
+        self.release(throttled)
+        if not throttled:
+            raise error
+        if attempt == self.max_retries:
+            self.counts["shed"] += 1
+            metrics.inc("idiomatic_model_shed_total", priority=priority, reason="throttled")
+            raise ModelUnavailable(f"model still throttled after {attempt + 1} attempts") from error
+        self.counts["retried"] += 1
+        record_retry(error)
+        time.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+
+    def call(self, call, *args, priority: str = INTERACTIVE, **kwargs):
+        """Run `call` under the limiter, retrying throttled attempts with full-jitter backoff"""
+        for attempt in range(self.max_retries + 1):
+            self._admit(priority)
+            try:
+                result = call(*args, **kwargs)
+            except Exception as e:
+                self._failed(e, attempt, priority)
+            else:
+                self.release()
+                return result
+
+    def stream(self, stream, *args, priority: str = INTERACTIVE, **kwargs):
+        """Like `call` for a streaming call, holding the slot until the stream ends.
+        Throttling is only retried up to the first chunk, after that the learner has seen output."""
+        for attempt in range(self.max_retries + 1):
+            self._admit(priority)
+            try:
+                chunks = iter(stream(*args, **kwargs))
+                first = next(chunks, None)
+            except Exception as e:
+                self._failed(e, attempt, priority)
+                continue
+            throttled = False
+            try:
+                if first is not None:
+                    yield first
+                yield from chunks
+            except Exception as e:
+                throttled = is_retriable(e)
+                raise
+            finally:
+                self.release(throttled)
+            return
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "limit": round(self.limit, 2),
+                "in_flight": self.in_flight,
+                "queued": dict(self.waiting),
+                "tokens": round(self._tokens, 2) if self.rate > 0 else None,
+                **self.counts,
+            }
+
+get_governor = shared(ModelCallGovernor)
+
 # Initialize Google GenAI Client
 # from kaggle_secrets import UserSecretsClient
 # GOOGLE_API_KEY = UserSecretsClient().get_secret("GOOGLE_API_KEY")
 # os.environ["GOOGLE_API_KEY"] = GOOGLE_API_KEY
 
-GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
+@shared
+def get_llm():
+    """For conversational tasks (intent detection, explanation)"""
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(
+        model="gemini-1.5-flash",
+        google_api_key=os.getenv('GOOGLE_API_KEY'),
+        temperature=0.7
+    )
 
-is_retriable = lambda e: (isinstance(e, genai.errors.APIError) and e.code in {429, 503})
-genai.models.Models.generate_content = retry.Retry(
-    predicate=is_retriable)(genai.models.Models.generate_content)
+@shared
+def get_client():
+    """For heavy generation (question generation)"""
+    return genai.Client(api_key=os.getenv('GOOGLE_API_KEY'))
 
-# For conversational tasks (intent detection, explanation)
-llm = ChatGoogleGenerativeAI(
-    model="gemini-1.5-flash",
-    google_api_key=GOOGLE_API_KEY,
-    temperature=0.7
-)
+@shared
+def get_llm_with_tools():
+    return get_llm().bind_tools(tools)
 
-# For heavy generation (question generation)
-client = genai.Client(api_key=GOOGLE_API_KEY)
+def set_models(llm=None, client=None):
+    """Use the given chat model and/or GenAI client instead of the default Gemini ones"""
+    if llm is not None:
+        get_llm.override(llm)
+        get_llm_with_tools.reset()
+    if client is not None:
+        get_client.override(client)
 
 
 ## Data Persistence
 
 """
-Initialize user data storage. Since this is a colab, we just use a JSON file for persistence
-More formally, we could've used a sqlite3 db etc.
+User data lives behind a small `UserStore` interface. The default backend is a WAL-mode SQLite
+database with one row per user, an append-only log of answers and one row per
+`repetition_schedule` entry (indexed by due time), so recording an answer is a couple of
+single-row writes and concurrent sessions don't clobber each other. The original JSON file is kept as a legacy
+backend (`IDIOMATIC_USER_STORE=json`); it still rewrites the whole file on every save. The first time
+a new SQLite store opens, users from an existing `user_data.json` are imported into it. The JSON
+history has no per-answer outcome or time, so imported answers take those from the idiom's
+schedule entry (or the import time).
 """
 
 USER_DATA_PATH = 'user_data.json'
-
-def load_user_data():
-    """Utility to load or initialize user data"""
+USER_DB_PATH = os.getenv('IDIOMATIC_USER_DB', 'user_data.db')
+USER_STORE_BACKEND = os.getenv('IDIOMATIC_USER_STORE', 'sqlite')
+
+def new_user_data(name=""):
+    return {"name": name, "user_level": "", "category": "general", "score": 0, "history": [], "repetition_schedule": {}}
+
+class UserStore:
+    """Interface for user data backends"""
+
+    keeps_answer_history = False  # whether `answer_events` can replay every answer
+
+    def load_user(self, name: str) -> dict:
+        """Profile and the HISTORY_LENGTH most recently answered idioms of a user (a fresh record if unknown).
+        The repetition schedule is read per idiom with `schedule_entry` and `due_reviews`."""
+        raise NotImplementedError
+
+    def save_profile(self, user_data: dict):
+        """Persist name, level and category. The score is maintained by `record_answer`."""
+        raise NotImplementedError
+
+    def record_answer(self, name: str, idiom: str, correct: bool, answered_at: str):
+        """Append an answer event and bump the user's score if it was correct"""
+        raise NotImplementedError
+
+    def upsert_schedule(self, name: str, idiom: str, entry: dict):
+        raise NotImplementedError
+
+    def schedule_entry(self, name: str, idiom: str):
+        """A user's schedule entry for one idiom, or None"""
+        raise NotImplementedError
+
+    def answer_events(self):
+        """Every recorded answer in order, as (user, idiom, correct, answered_at, user's current level)"""
+        raise NotImplementedError
+
+    def due_reviews(self, name: str, limit: int) -> list:
+        """The user's `limit` soonest-due scheduled idioms as (due, idiom) pairs, soonest first"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class JsonUserStore(UserStore):
+    """Legacy backend: every user in one JSON file that is rewritten on each save"""
+
+    def __init__(self, path=USER_DATA_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load_all(self) -> dict:
+        try:
+            with open(self.path, 'r') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return {}
+        # Files written before multi-user support hold a single user's record
+        if "name" in data:
+            return {data["name"]: data} if data["name"] else {}
+        return data.get("users", {})
+
+    def _save_all(self, users: dict):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump({"users": users}, file)
+        os.replace(tmp_path, self.path)
+
+    def _update(self, name: str, update):
+        with self._lock:
+            users = self._load_all()
+            update(users.setdefault(name, new_user_data(name)))
+            self._save_all(users)
+
+    def _record(self, name: str) -> dict:
+        with self._lock:
+            return {**new_user_data(name), **self._load_all().get(name, {})}
+
+    def load_user(self, name: str) -> dict:
+        record = self._record(name)
+        del record["repetition_schedule"]
+        record["history"] = record["history"][-HISTORY_LENGTH:]
+        return record
+
+    def save_profile(self, user_data: dict):
+        self._update(user_data["name"], lambda record: record.update(
+            {field: user_data[field] for field in ("user_level", "category") if field in user_data}
+        ))
+
+    def record_answer(self, name: str, idiom: str, correct: bool, answered_at: str):
+        def update(record):
+            record["history"].append(idiom)
+            record["score"] += int(correct)
+        self._update(name, update)
+
+    def upsert_schedule(self, name: str, idiom: str, entry: dict):
+        self._update(name, lambda record: record["repetition_schedule"].__setitem__(idiom, entry))
+
+    def schedule_entry(self, name: str, idiom: str):
+        return self._record(name)["repetition_schedule"].get(idiom)
+
+    def due_reviews(self, name: str, limit: int) -> list:
+        schedule = self._record(name)["repetition_schedule"]
+        return heapq.nsmallest(limit, ((schedule_due(entry), idiom) for idiom, entry in schedule.items()))
+
+class SqliteUserStore(UserStore):
+    """Default backend: per-user rows, append-only answers and upserted schedule entries in WAL-mode SQLite"""
+
+    keeps_answer_history = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            name TEXT PRIMARY KEY,
+            user_level TEXT NOT NULL DEFAULT '',
+            category TEXT NOT NULL DEFAULT 'general',
+            score INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS answers (
+            id INTEGER PRIMARY KEY,
+            user TEXT NOT NULL,
+            idiom TEXT NOT NULL,
+            correct INTEGER NOT NULL,
+            answered_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_answers_user ON answers (user, id);
+        CREATE TABLE IF NOT EXISTS schedule (
+            user TEXT NOT NULL,
+            idiom TEXT NOT NULL,
+            entry TEXT NOT NULL,
+            due REAL,
+            PRIMARY KEY (user, idiom)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_schedule_due ON schedule (user, due);
+    """
+
+    def __init__(self, path=USER_DB_PATH, legacy_path=USER_DATA_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock, self._conn:
+            self._conn.executescript(self.SCHEMA)
+            # user_version marks that the legacy JSON file was looked at, only an empty database imports it
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+                if legacy_path and not self._conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+                    self._import_legacy(legacy_path)
+                self._conn.execute("PRAGMA user_version = 1")
+
+    def _import_legacy(self, legacy_path: str):
+        """Copy every user in a JSON store into this (empty) database (caller holds the lock and a transaction)"""
+        users = JsonUserStore(legacy_path)._load_all()
+        now = datetime.utcnow().isoformat()
+        for name, record in users.items():
+            schedule = record.get("repetition_schedule") or {}
+            self._conn.execute(
+                "INSERT OR IGNORE INTO users (name, user_level, category, score) VALUES (?, ?, ?, ?)",
+                (name, record.get("user_level") or "", record.get("category") or "general", record.get("score", 0)),
+            )
+            self._conn.executemany(
+                "INSERT INTO answers (user, idiom, correct, answered_at) VALUES (?, ?, ?, ?)",
+                [(name, idiom, int(bool(schedule.get(idiom, {}).get("success"))), schedule.get(idiom, {}).get("last_seen", now))
+                 for idiom in record.get("history", [])],
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO schedule (user, idiom, entry, due) VALUES (?, ?, ?, ?)",
+                [(name, idiom, json.dumps(entry), schedule_due(entry)) for idiom, entry in schedule.items()],
+            )
+        if users:
+            logger.info("Imported %s users from %s into %s", len(users), legacy_path, self.path)
+
+    def load_user(self, name: str) -> dict:
+        user_data = new_user_data(name)
+        del user_data["repetition_schedule"]
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT user_level, category, score FROM users WHERE name = ?", (name,)
+            ).fetchone()
+            if row:
+                user_data.update(user_level=row[0], category=row[1], score=row[2])
+            user_data["history"] = [idiom for (idiom,) in self._conn.execute(
+                "SELECT idiom FROM answers WHERE user = ? ORDER BY id DESC LIMIT ?", (name, HISTORY_LENGTH)
+            )][::-1]
+        return user_data
+
+    def save_profile(self, user_data: dict):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO users (name, user_level, category) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET user_level = excluded.user_level, category = excluded.category",
+                (user_data["name"], user_data.get("user_level") or "", user_data.get("category") or "general"),
+            )
+
+    def record_answer(self, name: str, idiom: str, correct: bool, answered_at: str):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO answers (user, idiom, correct, answered_at) VALUES (?, ?, ?, ?)",
+                (name, idiom, int(correct), answered_at),
+            )
+            self._conn.execute(
+                "INSERT INTO users (name, score) VALUES (?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET score = score + excluded.score",
+                (name, int(correct)),
+            )
+
+    def upsert_schedule(self, name: str, idiom: str, entry: dict):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO schedule (user, idiom, entry, due) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (user, idiom) DO UPDATE SET entry = excluded.entry, due = excluded.due",
+                (name, idiom, json.dumps(entry), schedule_due(entry)),
+            )
+
+    def schedule_entry(self, name: str, idiom: str):
+        with self._lock:
+            row = self._conn.execute("SELECT entry FROM schedule WHERE user = ? AND idiom = ?", (name, idiom)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def due_reviews(self, name: str, limit: int) -> list:
+        with self._lock:
+            return [tuple(row) for row in self._conn.execute(
+                "SELECT due, idiom FROM schedule WHERE user = ? ORDER BY due LIMIT ?", (name, limit)
+            )]
+
+    def answer_events(self, page_size=10000):
+        last_id = 0
+        while True:
+            # Paged, so sessions can keep writing while a long export runs
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT a.id, a.user, a.idiom, a.correct, a.answered_at, COALESCE(u.user_level, '') "
+                    "FROM answers a LEFT JOIN users u ON u.name = a.user WHERE a.id > ? ORDER BY a.id LIMIT ?",
+                    (last_id, page_size),
+                ).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            for _, user, idiom, correct, answered_at, level in rows:
+                yield user, idiom, bool(correct), answered_at, level
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+USER_STORES = {"sqlite": SqliteUserStore, "json": JsonUserStore}
+
+def make_user_store(backend=USER_STORE_BACKEND) -> UserStore:
     try:
-        with open(USER_DATA_PATH, 'r') as file:
-            return json.load(file)
-    except FileNotFoundError:
-        return {"name": "", "score": 0, "history": [], "repetition_schedule": {}}
+        return USER_STORES[backend]()
+    except KeyError:
+        raise ValueError(f"Unknown user store backend {backend!r}, expected one of {sorted(USER_STORES)}")
 
-def save_user_data(user_data):
-    with open(USER_DATA_PATH, 'w') as file:
-        json.dump(user_data, file)
-
-user_data = load_user_data()
+get_user_store = shared(make_user_store)
 
 ## Agent Workflow
 
+"""
+The state is kept small so checkpointing it stays cheap: nodes return only the keys they change,
+`history` holds interned idiom ids for the last few questions, the full repetition schedule
+stays in the user store with only the soonest reviews queued here, and old messages are
+folded into the conversation summary and removed (see Conversation Window).
+"""
+
 class IdiomaticState(TypedDict):
     messages: Annotated[list, add_messages]
     name: str
     user_level: str
     category: str
     score: int
-    history: list[str]
-    repetition_schedule: dict
+    history: list[int]  # interned ids (see Question Bank) of the last HISTORY_LENGTH questions
+    review_queue: list  # the soonest [due, idiom id] pairs sorted by due time, see Spaced Repetition
+    conversation_summary: str  # rolling summary of turns outside the context window
+    summary_cursor: str  # id of the last message folded into the summary
     finished: bool
     last_question: dict
 
+HISTORY_LENGTH = 100  # questions kept in the session history, older ones are covered by the bank's seen table
+QUIZ_ANSWERS = {"a", "b", "c", "d"}
+QUIZ_MESSAGE_NAME = "quiz"  # name given to quiz result messages, which are left out of the LLM context
+
+
+## Input & Output
+
+"""
+Nodes don't call `input()` or `display()` themselves, they go through `read_input` and `render`.
+Rendering goes to an output sink: markdown as plain text in a terminal, IPython display in a
+notebook (IPython is only imported there), or a per-session buffer in server mode. Input always
+arrives through a LangGraph interrupt: the terminal driver prompts on stdin and resumes the graph
+with the reply, a server session resumes it with the learner's next message (see Server Mode).
+Every reply is its own graph run, so the recursion limit bounds a turn rather than a session.
+
+Long model replies are streamed with `render_stream`: text is shown as it arrives, printed
+piece by piece in a terminal, re-rendered in place in a notebook, and passed to a listening
+HTTP client in server mode. `IDIOMATIC_STREAM=0` turns streaming off.
+"""
+
+STREAM_RESPONSES = os.getenv('IDIOMATIC_STREAM', '1') == '1'
+
+
+class OutputSink:
+    """Where rendered markdown goes"""
+
+    def render(self, markdown: str):
+        raise NotImplementedError
+
+    def render_stream(self, pieces, prefix: str = "") -> str:
+        """Render text arriving in pieces, led by `prefix` once there is any; returns the text"""
+        text = "".join(pieces)
+        if text:
+            self.render(prefix + text)
+        return text
+
+class TerminalSink(OutputSink):
+    def render(self, markdown: str):
+        print(markdown)
+
+    def render_stream(self, pieces, prefix: str = "") -> str:
+        text = ""
+        try:
+            for piece in pieces:
+                if piece:
+                    print(piece if text else prefix + piece, end="", flush=True)
+                    text += piece
+        finally:
+            if text:
+                print()
+        return text
+
+class NotebookSink(OutputSink):
+    def __init__(self):
+        from IPython.display import Markdown, display
+        self._markdown = Markdown
+        self._display = display
+
+    def render(self, markdown: str):
+        self._display(self._markdown(markdown))
+
+    def render_stream(self, pieces, prefix: str = "") -> str:
+        text, handle = "", None
+        for piece in pieces:
+            if not piece:
+                continue
+            text += piece
+            if handle is None:
+                handle = self._display(self._markdown(prefix + text), display_id=True)
+            else:
+                handle.update(self._markdown(prefix + text))
+        return text
+
+class BufferSink(OutputSink):
+    """Collects output until it is drained, used for server sessions.
+    While a client streams a response, `listener` is also called with each output event."""
+
+    def __init__(self):
+        self.items = []
+        self.listener = None
+
+    def _notify(self, event: dict):
+        if self.listener is not None:
+            self.listener(event)
+
+    def render(self, markdown: str):
+        self._notify({"type": "render", "item": len(self.items), "markdown": markdown})
+        self.items.append(markdown)
+
+    def render_stream(self, pieces, prefix: str = "") -> str:
+        text = ""
+        try:
+            for piece in pieces:
+                if piece:
+                    self._notify({"type": "delta", "item": len(self.items), "text": piece if text else prefix + piece})
+                    text += piece
+        finally:
+            if text:
+                self.items.append(prefix + text)
+        return text
+
+    def drain(self) -> list:
+        items, self.items = self.items, []
+        return items
+
+def in_notebook() -> bool:
+    # Only look at IPython if something already imported it
+    ipython = sys.modules.get("IPython")
+    shell = ipython.get_ipython() if ipython else None
+    return shell is not None and type(shell).__name__ != "TerminalInteractiveShell"
+
+@shared
+def get_output_sink() -> OutputSink:
+    return NotebookSink() if in_notebook() else TerminalSink()
+
+def set_output_sink(sink: OutputSink):
+    get_output_sink.override(sink)
+
+current_session = ContextVar("idiomatic_session", default=None)
+
+def current_sink() -> OutputSink:
+    session = current_session.get()
+    return get_output_sink() if session is None else session.sink
+
+def render(markdown: str):
+    current_sink().render(markdown)
+
+def render_stream(pieces, prefix: str = "") -> str:
+    """Show text as it arrives, led by `prefix`; returns the text without it"""
+    return current_sink().render_stream(pieces, prefix)
+
+def read_input(prompt: str) -> str:
+    return interrupt(prompt)
+
 
 ## Question & Answer Generation
 
@@ -152,6 +1002,8 @@ class IdiomQuizItem:
   question: str  # The question about the idiom
   answer: str    # The expected answer
 
+GENERATE_QnA_MODEL = "gemini-2.0-flash"
+
 GENERATE_QnA_CONFIG = types.GenerateContentConfig(
     max_output_tokens=200,
     temperature=1.5,
@@ -160,96 +1012,1647 @@ GENERATE_QnA_CONFIG = types.GenerateContentConfig(
     response_schema=IdiomQuizItem
 )
 
+GENERATE_QnA_BATCH_SIZE = int(os.getenv('IDIOMATIC_BATCH_SIZE', 5))
+
+GENERATE_QnA_BATCH_PROMPT = GENERATE_QnA_PROMPT + """
+    When asked for several questions, output a JSON list of that many dicts in the format above.
+    Every dict in the list must test a different idiom.
+"""
+
+GENERATE_QnA_BATCH_CONFIG = types.GenerateContentConfig(
+    max_output_tokens=200 * GENERATE_QnA_BATCH_SIZE,
+    temperature=1.5,
+    top_p=0.95,
+    response_mime_type="application/json",
+    response_schema=list[IdiomQuizItem]
+)
+
+def generate_quiz_item(level: str, category: str, avoid=None, avoid_idioms=()) -> dict | None:
+    """Make live Gemini calls for a single valid IdiomQuizItem, None if every attempt was unusable.
+    The prompt asks to stay clear of `avoid_idioms`; items whose idiom `avoid(idiom)` is true for
+    are regenerated anyway."""
+    suffix = quiz_prompt(level, category, avoid_idioms=avoid_idioms)
+    for attempt in range(QUIZ_ITEM_ATTEMPTS):
+        response = generate_with_prefix("generate_question", GENERATE_QnA_PROMPT, suffix, GENERATE_QnA_CONFIG)
+        item = repair_json(response.text)
+        if isinstance(item, list):
+            item = item[0] if item else None
+        if was_truncated(response):
+            metrics.inc("idiomatic_quiz_responses_truncated_total", kind="single")
+        accepted = accept_quiz_items([item], "single")
+        if accepted and avoid is not None and avoid(accepted[0]["idiom"]):
+            metrics.inc("idiomatic_quiz_duplicates_total", kind="single")
+        elif accepted:
+            return accepted[0]
+        logger.debug("Regenerating unusable question (attempt %s)", attempt + 1)
+    return None
+
+# Served when no model capacity is left for a live question (the few-shot examples above)
+FALLBACK_QUESTIONS = [
+    {"idiom": "bite the bullet",
+     "question": "Q. 'Bite the bullet' means:\n a. to do something unpleasant that is unavoidable\n"
+                 " b. to react harshly under pressure\n c. to avoid making a tough decision\n d. to get into a fight",
+     "answer": "a"},
+    {"idiom": "go belly up",
+     "question": "Q. The startup was burning through cash, and unless they found an investor soon, they would ________.\n"
+                 " a. hit the hay\n b. go belly up\n c. pull someone’s leg\n d. throw in the towel",
+     "answer": "b"},
+    {"idiom": "circle the wagons",
+     "question": "Q. When the startup faced heavy media scrutiny, the team decided to ________ and protect their CEO.\n"
+                 " a. take the high road\n b. throw in the towel\n c. circle the wagons\n d. shoot from the hip",
+     "answer": "c"},
+]
+
+def generate_quiz_items(level: str, category: str, count: int = GENERATE_QnA_BATCH_SIZE, avoid_idioms=()) -> list[dict]:
+    """Ask Gemini for `count` distinct IdiomQuizItems in a single call, keeping only the well-formed ones"""
+    config = GENERATE_QnA_BATCH_CONFIG
+    if count != GENERATE_QnA_BATCH_SIZE:
+        config = config.model_copy(update={"max_output_tokens": 200 * count})
+    response = generate_with_prefix(
+        "generate_batch", GENERATE_QnA_BATCH_PROMPT, quiz_prompt(level, category, count, avoid_idioms), config,
+        priority=BACKGROUND,
+    )
+    if was_truncated(response):
+        metrics.inc("idiomatic_quiz_responses_truncated_total", kind="batch")
+    items = repair_json(response.text)
+    if items is None:
+        logger.warning("Unparseable batch of questions")
+        metrics.inc("idiomatic_quiz_items_total", kind="batch", outcome="rejected", reason="json")
+        return []
+    if not isinstance(items, list):
+        items = [items]
+
+    valid = []
+    for item in accept_quiz_items(items, "batch"):
+        if any(idiom_similarity(item["idiom"], other["idiom"]) >= NEAR_DUPLICATE_THRESHOLD for other in valid):
+            metrics.inc("idiomatic_quiz_duplicates_total", kind="batch")
+            continue
+        valid.append(item)
+    if len(valid) < len(items):
+        logger.debug("Dropped %s malformed/duplicate questions from batch", len(items) - len(valid))
+    return valid
+
+
+## Prompt Assembly
+
+"""
+A question request is the large, static few-shot prompt above plus a few lines that change per
+call: the learner's level, the category and a short list of idioms to stay away from
+(`quiz_prompt`). The static part always comes first and the per-call lines last, so consecutive
+requests share a long identical prefix that Gemini's implicit prompt caching can reuse. No
+explicit context cache is kept: the few-shot prompt is a few hundred tokens, far below the
+minimum the API accepts for cached content.
+"""
+
+PROMPT_AVOID_IDIOMS = int(os.getenv('IDIOMATIC_PROMPT_AVOID', 20))    # recent idioms listed in a prompt
+
+LEVEL_GUIDANCE = {
+    "beginner": "common, everyday idioms whose meaning is easy to guess from context, in short sentences with simple options",
+    "intermediate": "well-known idioms whose meaning isn't obvious from their literal words",
+    "advanced": "less common or more figurative idioms, with wrong options that are plausible",
+}
+
+def quiz_prompt(level: str, category: str, count: int = 1, avoid_idioms=()) -> str:
+    """The per-call part of a question request"""
+    topic = "on any topic" if category in ("", "general") else f"to do with {category}"
+    what = "one question" if count == 1 else f"{count} questions, each testing a different idiom,"
+    lines = [
+        f"Generate {what} for a {level} learner, using idioms {topic}.",
+        f"Choose {LEVEL_GUIDANCE.get(level, LEVEL_GUIDANCE['intermediate'])}.",
+    ]
+    avoid_idioms = list(avoid_idioms)[-PROMPT_AVOID_IDIOMS:]
+    if avoid_idioms:
+        lines.append(f"Do not use any of these idioms or variants of them: {'; '.join(avoid_idioms)}.")
+    return "\n".join(lines)
+
+def generate_with_prefix(kind: str, prefix: str, suffix: str, config, priority: str = INTERACTIVE):
+    """generate_content for a static prompt prefix followed by a per-call suffix"""
+    return model_call(
+        kind, get_client().models.generate_content,
+        model=GENERATE_QnA_MODEL,
+        contents=f"{prefix}\n{suffix}",
+        config=config,
+        priority=priority,
+    )
+
+
+## Question Validation
+
+"""
+Generated items are checked locally before anyone sees them. The JSON is parsed leniently
+(code fences are stripped, and truncated output is cut back to its last complete value, which
+salvages the finished items of a batch cut off by `max_output_tokens`). The options a-d are
+then parsed out of the question text, the answer must name one of them, and the idiom must
+appear in the stem or the options. Cheap fixes are applied in place: an answer given as "(B)"
+or as the option text becomes the letter, and a fill-in-the-blank item whose idiom appears in
+exactly one option gets that option as its answer. Anything else is rejected and regenerated
+(or dropped from a batch). Outcomes are counted once per item in `idiomatic_quiz_items_total`;
+valid items later dropped as near-duplicates are counted in `idiomatic_quiz_duplicates_total`.
+"""
+
+QUIZ_ITEM_ATTEMPTS = int(os.getenv('IDIOMATIC_QUIZ_ITEM_ATTEMPTS', 2))  # live calls per question before falling back
+
+OPTION_MARKER = re.compile(r"(?:^|(?<=\s))\(?([a-dA-D])[.)]\s+")
+ANSWER_LETTER = re.compile(r"^\(?([a-dA-D])(?:[.):]|\s|$)")
+
+def repair_json(text):
+    """Parse model JSON, salvaging fenced or truncated output; None if nothing is usable"""
+    text = re.sub(r"^```(?:json)?|```$", "", (text or "").strip()).strip()
+    starts = [index for index in (text.find("{"), text.find("[")) if index >= 0]
+    if not starts:
+        return None
+    text = text[min(starts):]
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    # Truncated: cut back to the end of a complete value and close whatever is still open
+    cuts, stack, in_string, escaped = [], [], False, False
+    for index, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]" and stack:
+            stack.pop()
+            cuts.append((index + 1, "".join(reversed(stack))))
+        elif char == ",":
+            cuts.append((index, "".join(reversed(stack))))
+    for cut, closers in reversed(cuts[-50:]):
+        try:
+            return json.loads(text[:cut] + closers)
+        except json.JSONDecodeError:
+            continue
+    return None
+
+def parse_options(question: str) -> tuple[str, dict]:
+    """Split a question into its stem and {letter: option}, reading markers a-d in order"""
+    markers = []
+    for match in OPTION_MARKER.finditer(question):
+        if len(markers) < len(QUIZ_ANSWERS) and match.group(1).lower() == "abcd"[len(markers)]:
+            markers.append(match)
+    if not markers:
+        return question.strip(), {}
+    options = {}
+    for marker, following in zip(markers, markers[1:] + [None]):
+        end = following.start() if following else len(question)
+        options[marker.group(1).lower()] = question[marker.end():end].strip().rstrip(",").strip()
+    return question[:markers[0].start()].strip(), options
+
+def loose_text(text: str) -> str:
+    """Lowercase words only, with curly quotes and punctuation dropped"""
+    return " ".join(re.findall(r"[a-z0-9]+", text.lower().replace("’", "'").replace("'", "")))
+
+def mentions_idiom(idiom: str, text: str) -> bool:
+    """Whether `text` contains the idiom, allowing for inflection ("bit the bullet") and pronouns"""
+    idiom, text = loose_text(idiom), loose_text(text)
+    if idiom in text:
+        return True
+    words = [word for word in idiom.split() if len(word) > 2]
+    prefixes = {word[:3] for word in text.split()}
+    return bool(words) and sum(word[:3] in prefixes for word in words) >= 2 / 3 * len(words)
+
+def validate_quiz_item(item) -> tuple[dict | None, str]:
+    """Check and, where it is cheap, repair a generated item.
+    Returns (item, "ok" | "repaired") or (None, reason it was rejected)."""
+    if not isinstance(item, dict) or not all(
+            isinstance(item.get(field), str) and item[field].strip() for field in ("idiom", "question")):
+        return None, "missing_field"
+    idiom = item["idiom"].strip()
+    question = item["question"].strip().replace("\\n", "\n")
+    answer = item.get("answer") if isinstance(item.get("answer"), str) else ""
+    repaired = question != item["question"].strip()
+
+    stem, options = parse_options(question)
+    if set(options) != QUIZ_ANSWERS or not all(options.values()):
+        return None, "options"
+    in_options = [letter for letter, option in options.items() if mentions_idiom(idiom, option)]
+    if not in_options and not mentions_idiom(idiom, stem):
+        return None, "idiom"
+
+    letter = ANSWER_LETTER.match(answer.strip())
+    if letter:
+        letter = letter.group(1).lower()
+    else:
+        # The option text instead of its letter
+        matching = [key for key, option in options.items() if answer.strip() and loose_text(option) == loose_text(answer)]
+        letter = matching[0] if len(matching) == 1 else None
+    # A fill-in-the-blank item has to be answered with the option holding the idiom
+    if len(in_options) == 1 and not mentions_idiom(idiom, stem) and letter != in_options[0]:
+        letter = in_options[0]
+    if letter is None:
+        return None, "answer"
+    repaired = repaired or letter != answer.strip()
+    return {**item, "idiom": idiom, "question": question, "answer": letter}, "repaired" if repaired else "ok"
+
+def is_valid_quiz_item(item) -> bool:
+    """Check that an item passes validation as it is"""
+    return validate_quiz_item(item)[1] == "ok"
+
+def accept_quiz_items(items, kind: str) -> list[dict]:
+    """Validate (and repair) generated items, counting the outcome of each"""
+    accepted = []
+    for item in items:
+        item, outcome = validate_quiz_item(item)
+        if item is None:
+            metrics.inc("idiomatic_quiz_items_total", kind=kind, outcome="rejected", reason=outcome)
+            logger.debug("Rejected generated question (%s)", outcome)
+            continue
+        metrics.inc("idiomatic_quiz_items_total", kind=kind, outcome=outcome)
+        accepted.append(item)
+    return accepted
+
+def quiz_item_stats() -> dict:
+    total = metrics.value("idiomatic_quiz_items_total")
+    rejected = metrics.value("idiomatic_quiz_items_total", outcome="rejected")
+    return {
+        "generated": int(total),
+        "repaired": int(metrics.value("idiomatic_quiz_items_total", outcome="repaired")),
+        "rejected": int(rejected),
+        "reject_rate": rejected / total if total else 0.0,
+        "duplicates": int(metrics.value("idiomatic_quiz_duplicates_total")),
+    }
+
+def was_truncated(response) -> bool:
+    candidates = getattr(response, "candidates", None) or []
+    return any(str(getattr(candidate, "finish_reason", "")).endswith("MAX_TOKENS") for candidate in candidates)
+
+
+## Question Pool
+
+"""
+Generating a question is the slowest hop in the quiz loop, so we keep a small pool of
+ready questions per (user_level, category). The pool is topped up on a background thread
+while the user is still answering, and `generate_idiom_question` only makes a live call
+when the pool for its slice is empty. Items a learner has already seen are handed to `keep`
+(the question bank) rather than thrown away, so other learners still get them.
+"""
+
+QUESTION_POOL_DEPTH = int(os.getenv('IDIOMATIC_POOL_DEPTH', 5))                  # questions kept ready per slice
+QUESTION_POOL_LOW_WATERMARK = int(os.getenv('IDIOMATIC_POOL_LOW_WATERMARK', 2))  # refill once a slice drops to this
+QUESTION_POOL_WORKERS = int(os.getenv('IDIOMATIC_POOL_WORKERS', 2))
+
+class QuestionPool:
+    """Prefetched, validated quiz items keyed by (user_level, category)"""
+
+    def __init__(self, generate, depth=QUESTION_POOL_DEPTH, low_watermark=QUESTION_POOL_LOW_WATERMARK,
+                 max_workers=QUESTION_POOL_WORKERS, keep=None):
+        self.generate = generate  # callable(level, category) -> list of quiz items
+        self.keep = keep          # callable(items, level, category) for skipped items, None drops them
+        self.depth = depth
+        self.low_watermark = low_watermark
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_errors = 0
+        self._queues = defaultdict(deque)
+        self._pending = set()  # slices with a refill in flight
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="idiomatic-pool")
+
+    def get(self, level: str, category: str, skip=None):
+        """Pop a ready item for the slice (or None on a miss) and top the slice back up.
+        Items for which `skip(item)` is true are passed to `keep`."""
+        skipped = []
+        with self._lock:
+            queue = self._queues[(level, category)]
+            item = None
+            while queue and item is None:
+                item = queue.popleft()
+                if skip is not None and skip(item):
+                    skipped.append(item)
+                    item = None
+            if item is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if skipped and self.keep is not None:
+            self.keep(skipped, level, category)
+        metrics.inc("idiomatic_cache_lookups_total", cache="question_pool", result="miss" if item is None else "hit")
+        self.refill(level, category)
+        return item
+
+    def refill(self, level: str, category: str) -> bool:
+        """Schedule a background refill if the slice is at or below the low watermark"""
+        key = (level, category)
+        with self._lock:
+            if key in self._pending or len(self._queues[key]) > self.low_watermark:
+                return False
+            self._pending.add(key)
+            self.refills += 1
+        self._executor.submit(self._fill, key)
+        return True
+
+    def _fill(self, key):
+        try:
+            while True:
+                with self._lock:
+                    if len(self._queues[key]) >= self.depth:
+                        break
+                items = [item for item in self.generate(*key) if is_valid_quiz_item(item)]
+                if not items:
+                    # An unusable batch, leave it to the next refill rather than paying for more now
+                    with self._lock:
+                        self.refill_errors += 1
+                    break
+                with self._lock:
+                    queue = self._queues[key]
+                    queue.extend(items[:max(self.depth - len(queue), 0)])
+        except Exception as e:
+            with self._lock:
+                self.refill_errors += 1
+            logger.error("Error refilling question pool for %s: %s", key, e)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "depth": self.depth,
+                "low_watermark": self.low_watermark,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "refills": self.refills,
+                "refill_errors": self.refill_errors,
+                "ready": {f"{level}/{category}": len(queue) for (level, category), queue in self._queues.items()},
+            }
+
+    def drain(self) -> dict:
+        """Remove and return every ready item, keyed by (level, category)"""
+        with self._lock:
+            drained = {key: list(queue) for key, queue in self._queues.items() if queue}
+            self._queues.clear()
+            return drained
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+def generate_pool_batch(level: str, category: str) -> list[dict]:
+    """A batch for the pool, steering clear of the idioms most recently banked for the slice"""
+    return generate_quiz_items(
+        level, category, avoid_idioms=get_question_bank().recent_idioms(level, category, PROMPT_AVOID_IDIOMS)
+    )
+
+get_question_pool = shared(lambda: QuestionPool(
+    generate_pool_batch, keep=lambda items, level, category: get_question_bank().add_many(items, level, category)
+))
+
+
+## Near-Duplicate Idioms
+
+"""
+Exact keys miss variants like "bite the bullet" / "biting the bullet" or "pull someone's leg" /
+"pull my leg". `idiom_signature` reduces an idiom to lightly stemmed content words, and two
+idioms count as the same when the character 3-gram sets of their signatures overlap by at least
+`NEAR_DUPLICATE_THRESHOLD` (Jaccard). Comparing against every stored idiom would be a linear
+scan, so the question bank keeps MinHash LSH buckets of each idiom in SQLite: a lookup computes
+the candidate's MinHash, fetches the few idioms sharing a band bucket through the index, and
+only verifies those. Each idiom and its variants share one interned id, which is what the
+session history holds.
+"""
+
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv('IDIOMATIC_NEAR_DUPLICATE_THRESHOLD', 0.6))
+MINHASH_BANDS, MINHASH_ROWS = 10, 3  # candidates from about 0.45 similarity, nearly all pairs above 0.7
+
+IDIOM_SLOT_WORDS = {
+    "a", "an", "the", "one", "ones", "someone", "someones", "somebody", "somebodys", "something",
+    "my", "your", "his", "her", "its", "our", "their", "me", "you", "him", "them", "us",
+}
+IRREGULAR_FORMS = {
+    "bit": "bite", "bitten": "bite", "took": "take", "taken": "take", "went": "go", "gone": "go",
+    "got": "get", "gotten": "get", "broke": "break", "broken": "break", "threw": "throw",
+    "thrown": "throw", "spilt": "spill", "kept": "keep", "made": "make", "ran": "run",
+    "caught": "catch", "held": "hold", "drew": "draw", "drawn": "draw", "bought": "buy",
+}
+
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_rng = random.Random(20250101)  # fixed, bucket ids are stored on disk
+MINHASH_PARAMS = [
+    (_minhash_rng.randrange(1, _MINHASH_PRIME), _minhash_rng.randrange(_MINHASH_PRIME))
+    for _ in range(MINHASH_BANDS * MINHASH_ROWS)
+]
+
+def stem_word(word: str) -> str:
+    word = IRREGULAR_FORMS.get(word, word)
+    for suffix in ("ing", "ed", "es", "s"):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3 and not (suffix == "s" and word.endswith("ss")):
+            word = word[:-len(suffix)]
+            if len(word) >= 4 and word[-1] == word[-2] and word[-1] not in "lsz":
+                word = word[:-1]  # getting -> get
+            break
+    return word[:-1] if len(word) > 3 and word.endswith("e") else word
+
+def idiom_signature(idiom: str) -> str:
+    """Stemmed content words of an idiom, with articles and pronoun slots dropped"""
+    words = normalize_idiom(idiom).replace("'", "").split()
+    content = [stem_word(word) for word in words if word not in IDIOM_SLOT_WORDS]
+    return " ".join(content or words)
+
+def idiom_shingles(idiom: str) -> frozenset:
+    text = f" {idiom_signature(idiom)} "
+    return frozenset(text[index:index + 3] for index in range(len(text) - 2))
+
+def idiom_similarity(first: str, second: str) -> float:
+    a, b = idiom_shingles(first), idiom_shingles(second)
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+def idiom_buckets(idiom: str) -> list[tuple[int, int]]:
+    """(band, bucket) pairs of the idiom's MinHash signature, for the LSH index"""
+    hashes = [zlib.crc32(shingle.encode()) for shingle in idiom_shingles(idiom)]
+    minhash = [min((a * h + b) % _MINHASH_PRIME for h in hashes) for a, b in MINHASH_PARAMS]
+    return [
+        (band, zlib.crc32(repr(minhash[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]).encode()))
+        for band in range(MINHASH_BANDS)
+    ]
+
+
+## Question Bank
+
+"""
+Every question we serve is kept in a local SQLite bank together with a normalized idiom key,
+and we remember which idioms each user has already seen. `generate_idiom_question` serves
+unseen questions from the bank first, so a question generated for one learner is reused by
+the next one instead of paying for another Gemini call, and nobody sees the same idiom twice.
+Variants of a known idiom resolve to its key (see Near-Duplicate Idioms), so they are stored,
+found and marked seen as that idiom.
+"""
+
+QUESTION_BANK_PATH = os.getenv('IDIOMATIC_QUESTION_BANK', 'question_bank.db')
+
+def normalize_idiom(idiom: str) -> str:
+    """Normalized key for an idiom: lowercase, plain apostrophes, no punctuation or extra spaces"""
+    idiom = idiom.lower().replace("\u2019", "'").replace("\u2018", "'")
+    idiom = re.sub(r"[^\w\s']", " ", idiom)
+    return " ".join(word.strip("'") for word in idiom.split() if word.strip("'"))
+
+class QuestionBank:
+    """On-disk store of generated quiz items with per-user seen tracking"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS questions (
+            id INTEGER PRIMARY KEY,
+            idiom TEXT NOT NULL,
+            idiom_key TEXT NOT NULL,
+            level TEXT NOT NULL,
+            category TEXT NOT NULL,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            UNIQUE (idiom_key, level, category)
+        );
+        CREATE INDEX IF NOT EXISTS idx_questions_idiom ON questions (idiom_key);
+        CREATE INDEX IF NOT EXISTS idx_questions_slice ON questions (level, category, id);
+        CREATE TABLE IF NOT EXISTS seen (
+            user TEXT NOT NULL,
+            idiom_key TEXT NOT NULL,
+            seen_at TEXT NOT NULL,
+            PRIMARY KEY (user, idiom_key)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS idiom_buckets (
+            band INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            idiom_key TEXT NOT NULL,
+            PRIMARY KEY (band, bucket, idiom_key)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS idioms (
+            id INTEGER PRIMARY KEY,
+            idiom_key TEXT NOT NULL UNIQUE,
+            idiom TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path=QUESTION_BANK_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._texts = {}  # idiom id -> idiom, ids never change
+        with self._lock, self._conn:
+            self._conn.executescript(self.SCHEMA)
+
+    def _register(self, key: str, idiom: str) -> int:
+        """Intern an idiom and add it to the similarity index, returns its id (caller holds the lock)"""
+        cursor = self._conn.execute("INSERT OR IGNORE INTO idioms (idiom_key, idiom) VALUES (?, ?)", (key, idiom))
+        if not cursor.rowcount:
+            return self._conn.execute("SELECT id FROM idioms WHERE idiom_key = ?", (key,)).fetchone()[0]
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO idiom_buckets (band, bucket, idiom_key) VALUES (?, ?, ?)",
+            [(band, bucket, key) for band, bucket in idiom_buckets(key)],
+        )
+        return cursor.lastrowid
+
+    def _resolve(self, idiom: str, register=False) -> tuple[int | None, str]:
+        """(id, key) of the stored idiom this one is, or is a near-duplicate of. Unknown idioms keep
+        their own key, and get an id only when `register` is set (caller holds the lock)."""
+        key = normalize_idiom(idiom)
+        row = self._conn.execute("SELECT id FROM idioms WHERE idiom_key = ?", (key,)).fetchone()
+        if row is not None:
+            return row[0], key
+        buckets = idiom_buckets(key)
+        candidates = self._conn.execute(
+            "SELECT DISTINCT i.id, i.idiom_key FROM idiom_buckets b JOIN idioms i USING (idiom_key) WHERE "
+            + " OR ".join(["(b.band = ? AND b.bucket = ?)"] * len(buckets)),
+            [value for pair in buckets for value in pair],
+        ).fetchall()
+        best = max(((idiom_similarity(key, other), other, other_id) for other_id, other in candidates), default=None)
+        if best is not None and best[0] >= NEAR_DUPLICATE_THRESHOLD:
+            metrics.inc("idiomatic_near_duplicates_total", source="bank")
+            return best[2], best[1]
+        if register:
+            return self._register(key, idiom.strip()), key
+        return None, key
+
+    def canonical_key(self, idiom: str) -> str:
+        with self._lock:
+            return self._resolve(idiom)[1]
+
+    def idiom_id(self, idiom: str, register=True) -> int | None:
+        """Interned id of an idiom (shared with its near-duplicates); None if unknown and not registered"""
+        with self._lock, self._conn:
+            return self._resolve(idiom, register)[0]
+
+    def idiom_text(self, idiom_id: int) -> str | None:
+        if idiom_id not in self._texts:
+            with self._lock:
+                row = self._conn.execute("SELECT idiom FROM idioms WHERE id = ?", (idiom_id,)).fetchone()
+            if row is None:
+                return None
+            self._texts[idiom_id] = row[0]
+        return self._texts[idiom_id]
+
+    def add(self, item: dict, level: str, category: str) -> bool:
+        """Store a quiz item, returns False if the slice already has a question for this idiom (or a variant)"""
+        return self.add_many([item], level, category) == 1
+
+    def add_many(self, items, level: str, category: str) -> int:
+        with self._lock, self._conn:
+            rows = [
+                (item["idiom"], self._resolve(item["idiom"], register=True)[1], level, category,
+                 item["question"], item["answer"], datetime.utcnow().isoformat())
+                for item in items
+            ]
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO questions (idiom, idiom_key, level, category, question, answer, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            return self._conn.total_changes - before
+
+    def count(self, level: str, category: str) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM questions WHERE level = ? AND category = ?", (level, category)
+            ).fetchone()[0]
+
+    def recent_idioms(self, level: str, category: str, limit: int) -> list[str]:
+        """The slice's `limit` most recently stored idioms, oldest first"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT idiom FROM questions WHERE level = ? AND category = ? ORDER BY id DESC LIMIT ?",
+                (level, category, limit),
+            ).fetchall()
+        return [row[0] for row in reversed(rows)]
+
+    def next_unseen(self, user: str, level: str, category: str):
+        """Oldest question in the slice whose idiom the user hasn't seen yet, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT idiom, question, answer FROM questions q "
+                "WHERE level = ? AND category = ? "
+                "AND NOT EXISTS (SELECT 1 FROM seen s WHERE s.user = ? AND s.idiom_key = q.idiom_key) "
+                "ORDER BY id LIMIT 1",
+                (level, category, user),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def find(self, idiom: str):
+        """Any stored question for the given idiom, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT idiom, question, answer FROM questions WHERE idiom_key = ? ORDER BY id LIMIT 1",
+                (self._resolve(idiom)[1],),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def has_seen(self, user: str, idiom: str) -> bool:
+        """Whether the user has seen this idiom or a near-duplicate of it"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM seen WHERE user = ? AND idiom_key = ?", (user, self._resolve(idiom)[1])
+            ).fetchone() is not None
+
+    def mark_seen(self, user: str, idiom: str):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO seen (user, idiom_key, seen_at) VALUES (?, ?, ?)",
+                (user, self._resolve(idiom, register=True)[1], datetime.utcnow().isoformat()),
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+get_question_bank = shared(QuestionBank)
+
+
+## Spaced Repetition
+
+"""
+Each answered idiom gets an SM-2 style schedule entry (interval, ease, repetitions, due time),
+upserted into the user store, which indexes entries by due time. The session only holds
+`review_queue`: the REVIEW_QUEUE_SIZE soonest [due, idiom id] pairs, as a short list sorted by
+due time. Rescheduling replaces an idiom's pair in a copy of the list (the checkpoint needs a new
+value anyway), and an empty queue is refilled from the store with one indexed query, so the next
+due review is at the front of a list of at most REVIEW_QUEUE_SIZE pairs however many idioms a
+user has scheduled.
+"""
+
+REVIEW_MIX = float(os.getenv('IDIOMATIC_REVIEW_MIX', 0.5))  # chance a question slot goes to a due review
+RELEARN_DELAY = 10 * 60                                      # seconds before a missed idiom comes back
+MIN_EASE = 1.3
+REVIEW_QUEUE_SIZE = 50                                       # soonest reviews kept in the session state
+
+def timestamp(iso_time: str) -> float:
+    """UNIX timestamp of the naive UTC ISO times kept in schedule entries and answers"""
+    return datetime.fromisoformat(iso_time).replace(tzinfo=timezone.utc).timestamp()
+
+def schedule_due(entry: dict) -> float:
+    """Due time of a schedule entry as a UNIX timestamp (entries from before scheduling are due at last_seen)"""
+    if "due" in entry:
+        return entry["due"]
+    return timestamp(entry["last_seen"])
+
+def schedule_review(entry, correct: bool, now: float) -> dict:
+    """SM-2 update of a schedule entry after an answer"""
+    entry = dict(entry or {})
+    ease = entry.get("ease", 2.5)
+    reps = entry.get("reps", 0)
+    interval = entry.get("interval", 0.0)  # days
+
+    quality = 4 if correct else 1
+    ease = max(MIN_EASE, ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+    if correct:
+        reps += 1
+        interval = 1.0 if reps == 1 else 6.0 if reps == 2 else round(interval * ease, 2)
+        due = now + interval * 86400
+    else:
+        entry["lapses"] = entry.get("lapses", 0) + 1
+        reps, interval = 0, 0.0
+        due = now + RELEARN_DELAY
+
+    entry.update({
+        "last_seen": datetime.fromtimestamp(now, timezone.utc).replace(tzinfo=None).isoformat(),
+        "success": correct,
+        "interval": interval,
+        "ease": round(ease, 3),
+        "reps": reps,
+        "due": due,
+    })
+    return entry
+
+def load_review_queue(name: str) -> list:
+    """The user's soonest-due reviews from the store, as a review queue of idiom ids"""
+    bank = get_question_bank()
+    return [[due, bank.idiom_id(idiom)] for due, idiom in get_user_store().due_reviews(name, REVIEW_QUEUE_SIZE)]
+
+def push_review(queue: list, idiom_id: int, due: float) -> list:
+    """A copy of the queue with the idiom (re)scheduled, keeping the REVIEW_QUEUE_SIZE soonest"""
+    queue = [pair for pair in queue if pair[1] != idiom_id]
+    bisect.insort(queue, [due, idiom_id])
+    return queue[:REVIEW_QUEUE_SIZE]
+
+def pop_due_review(queue: list, now: float, lookup) -> tuple[dict | None, list]:
+    """The question `lookup(idiom_id)` finds for the most overdue idiom it has one for (None if there
+    is none) and the queue without that idiom. Due idioms without a question stay queued."""
+    for index, (due, idiom_id) in enumerate(queue):
+        if due > now:
+            break
+        qna = lookup(idiom_id)
+        if qna is not None:
+            return qna, queue[:index] + queue[index + 1:]
+    return None, queue
+
+def review_question(idiom: str):
+    """A question for reviewing an idiom: one from the bank, or the fallback question it came from"""
+    bank = get_question_bank()
+    qna = bank.find(idiom)
+    if qna is None:
+        key = bank.idiom_id(idiom, register=False)
+        qna = next((dict(item) for item in FALLBACK_QUESTIONS if bank.idiom_id(item["idiom"], register=False) == key), None)
+    return qna
+
 def generate_idiom_question(state: IdiomaticState) -> IdiomaticState:
-    """Use Gemini to dynamically generate an idiom and an associated Q/A"""
-    print("--- Generating Question ---")
+    """Serve an unseen idiom Q/A from the question bank or the prefetched pool, falling back to a live Gemini call"""
+    logger.debug("Generating Question")
     difficulty = state["user_level"]
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=GENERATE_QnA_PROMPT,
-        config=GENERATE_QnA_CONFIG,
-    )
-    qna = json.loads(response.text)
-    state["last_question"] = qna
-    state["history"].append(qna["idiom"])
-    display(Markdown(qna["question"]))
-    return state
+    category = state.get("category") or "general"
+    user = state.get("name") or ""
+    bank = get_question_bank()
+    recent = set(state["history"])
+    # Near-duplicates of anything the learner has seen count as seen
+    repeats = lambda idiom: bank.idiom_id(idiom, register=False) in recent or bank.has_seen(user, idiom)
+
+    qna = None
+    review_queue = state.get("review_queue") or []
+    if not review_queue and user:
+        review_queue = load_review_queue(user)
+    if review_queue and random.random() < REVIEW_MIX:
+        qna, review_queue = pop_due_review(
+            review_queue, time.time(), lambda idiom_id: review_question(bank.idiom_text(idiom_id))
+        )
+    if qna is not None:
+        logger.debug("Serving Due Review: %s", qna['idiom'])
+        source = "review"
+        render("🔁 Time to review an idiom you've seen before.")
+    else:
+        qna = bank.next_unseen(user, difficulty, category)
+        if qna is not None:
+            logger.debug("Serving Question from Bank")
+            source = "bank"
+        else:
+            qna = get_question_pool().get(difficulty, category, skip=lambda item: repeats(item["idiom"]))
+            source = "pool"
+            if qna is None:
+                logger.debug("Question Pool Empty, Generating Live")
+                source = "live"
+                try:
+                    recent_idioms = [bank.idiom_text(idiom_id) for idiom_id in state["history"][-PROMPT_AVOID_IDIOMS:]]
+                    qna = generate_quiz_item(difficulty, category, avoid=repeats, avoid_idioms=recent_idioms)
+                except ModelUnavailable as e:
+                    logger.warning("Model unavailable for a live question: %s", e)
+                if qna is None:
+                    logger.debug("Serving a Fallback Question")
+                    source = "fallback"
+                    unseen = [item for item in FALLBACK_QUESTIONS if bank.idiom_id(item["idiom"], register=False) not in recent]
+                    qna = dict(random.choice(unseen or FALLBACK_QUESTIONS))
+            if source != "fallback":
+                bank.add(qna, difficulty, category)
+        bank.mark_seen(user, qna["idiom"])
+    metrics.inc("idiomatic_questions_total", source=source)
+
+    render(qna["question"])
+    update = {"last_question": qna, "history": (state["history"] + [bank.idiom_id(qna["idiom"])])[-HISTORY_LENGTH:]}
+    if review_queue != state.get("review_queue"):
+        update["review_queue"] = review_queue
+    return update
 
 def evaluate_quiz_answer(state: IdiomaticState) -> IdiomaticState:
-    print("--- Evaluating Answer ---")
+    logger.debug("Evaluating Answer")
     user_input = state["messages"][-1].content.strip().lower()
     correct = state["last_question"]["answer"].lower() if state.get("last_question") else None
 
-    result_message = ""
+    score = state["score"]
     if user_input == correct:
         result_message = "✅ Correct!"
-        state["score"] += 1
+        score += 1
         success = True
     else:
         result_message = f"❌ Incorrect! The correct answer was '{correct}'."
         success = False
     
-    display(Markdown(result_message))
-    state['messages'].append(AIMessage(content=result_message))
+    render(result_message)
 
+    name = state.get("name")
     idiom = state["last_question"]["idiom"]
-    state["repetition_schedule"][idiom] = {
-        "last_seen": datetime.utcnow().isoformat(),
-        "success": success
+    idiom_id = get_question_bank().idiom_id(idiom)
+    now = time.time()
+    previous = get_user_store().schedule_entry(name, idiom) if name else None
+    entry = schedule_review(previous, success, now)
+    if name:
+        get_user_store().record_answer(name, idiom, success, entry["last_seen"])
+        get_user_store().upsert_schedule(name, idiom, entry)
+    if get_answer_log() is not None:
+        gap = now - timestamp(previous["last_seen"]) if previous else -1.0
+        get_answer_log().append([(now, name or "", idiom_id, state["user_level"], success, gap)])
+
+    return {
+        "messages": [AIMessage(content=result_message, name=QUIZ_MESSAGE_NAME)],
+        "score": score,
+        "review_queue": push_review(state.get("review_queue") or [], idiom_id, entry["due"]),
     }
 
-    return state
+
+## Answer Analytics
+
+"""
+Every answer is also appended to a columnar event log (`IDIOMATIC_ANSWER_LOG`, a directory with
+one file per column): when, who (a 64-bit hash of the name), the interned idiom id, the level,
+whether it was right, and the seconds since that user last answered that idiom (-1 the first
+time). Columns are plain typed arrays, so loading millions of events is one bulk read per
+column, and the aggregations (error rate per idiom, accuracy per level, a retention curve of
+accuracy against time since last seen) count whole columns at once with C-implemented builtins
+(`Counter`, `itertools.compress`, `map`) rather than looping over per-user dicts.
+`python idiomatic.py analytics` prints them; `--rebuild` refills the log from the user store.
+"""
+
+ANSWER_LOG_PATH = os.getenv('IDIOMATIC_ANSWER_LOG', 'answer_log')  # empty string disables the log
+LEVEL_CODES = {"": 0, "beginner": 1, "intermediate": 2, "advanced": 3}
+RETENTION_BUCKETS = [  # (upper bound in seconds since last seen, label)
+    (3600, "<1h"), (86400, "<1d"), (3 * 86400, "<3d"), (7 * 86400, "<1w"), (30 * 86400, "<30d"), (float("inf"), "30d+"),
+]
+
+def user_hash(name: str) -> int:
+    return int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), "little")
+
+def ratio_by(keys, flags) -> dict:
+    """(count, share of true flags) for each distinct key, over whole columns"""
+    totals = Counter(keys)
+    hits = Counter(compress(keys, flags))
+    return {key: (count, hits[key] / count) for key, count in totals.items()}
+
+class AnswerLog:
+    """Append-only, column-per-file log of answer events"""
+
+    COLUMNS = {"time": "d", "user": "Q", "idiom": "I", "level": "B", "correct": "B", "gap": "d"}
+
+    def __init__(self, path=ANSWER_LOG_PATH):
+        self.path = os.path.normpath(path)
+        self.appended = 0
+        self._lock = threading.Lock()
+        # The lock file sits next to the directory, so it outlives a rebuild swapping the directory
+        self._lock_file = open(f"{self.path}.lock", "ab")
+        self._files = {}
+        with self._locked():
+            pass
+
+    def _column_path(self, column: str) -> str:
+        return os.path.join(self.path, f"{column}.col")
+
+    def _open_files(self):
+        """(Re)open the column files if they aren't open yet or a rebuild replaced them (caller holds the lock)"""
+        try:
+            current = os.stat(self._column_path("time")).st_ino
+        except FileNotFoundError:
+            current = None
+        if self._files and current == os.fstat(self._files["time"].fileno()).st_ino:
+            return
+        for file in self._files.values():
+            file.close()
+        os.makedirs(self.path, exist_ok=True)
+        self._files = {column: open(self._column_path(column), "ab") for column in self.COLUMNS}
+
+    @contextmanager
+    def _locked(self):
+        """The in-process lock, plus (where available) a file lock shared with other processes"""
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                self._open_files()
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _rows(self) -> int:
+        """Complete rows, cutting off a row some writer didn't finish (caller holds the lock)"""
+        sizes = {column: os.fstat(file.fileno()).st_size for column, file in self._files.items()}
+        rows = min(sizes[column] // array(typecode).itemsize for column, typecode in self.COLUMNS.items())
+        for column, typecode in self.COLUMNS.items():
+            if sizes[column] != rows * array(typecode).itemsize:
+                self._files[column].truncate(rows * array(typecode).itemsize)
+        return rows
+
+    def append(self, events):
+        """Append (time, user name, idiom id, level, correct, seconds since last seen) events"""
+        if not events:
+            return
+        times, users, idioms, levels, correct, gaps = zip(*events)
+        values = {
+            "time": times,
+            "user": map(user_hash, users),
+            "idiom": idioms,
+            "level": (LEVEL_CODES.get(level, 0) for level in levels),
+            "correct": map(int, correct),
+            "gap": gaps,
+        }
+        with self._locked():
+            self._rows()
+            for column, typecode in self.COLUMNS.items():
+                self._files[column].write(array(typecode, values[column]).tobytes())
+            for file in self._files.values():
+                file.flush()
+            self.appended += len(events)
+
+    def clear(self):
+        with self._locked():
+            for file in self._files.values():
+                file.truncate(0)
+
+    def _read_columns(self) -> dict:
+        """(caller holds the lock)"""
+        rows = self._rows()
+        data = {}
+        for column, typecode in self.COLUMNS.items():
+            data[column] = array(typecode)
+            with open(self._column_path(column), "rb") as file:
+                data[column].fromfile(file, rows)
+        return data
+
+    def replace_with(self, rebuilt: "AnswerLog", keep):
+        """Swap in a rebuilt log's directory, first copying over the current rows where `keep(time, user)` holds"""
+        with self._locked():
+            data = self._read_columns()
+            kept = bytes(map(keep, data["time"], data["user"]))
+            with rebuilt._locked():
+                rebuilt._rows()
+                for column, values in data.items():
+                    rebuilt._files[column].write(array(values.typecode, compress(values, kept)).tobytes())
+            rebuilt.close()
+            old_path = f"{self.path}.old"
+            shutil.rmtree(old_path, ignore_errors=True)
+            os.rename(self.path, old_path)
+            os.rename(rebuilt.path, self.path)
+            shutil.rmtree(old_path)
+            self._open_files()
+
+    def columns(self, since=None) -> dict:
+        """Every column as an array, optionally only the events at or after `since` (a UNIX time)"""
+        with self._locked():
+            data = self._read_columns()
+        if since is not None:
+            keep = bytes(map(operator.le, repeat(since), data["time"]))
+            data = {column: array(values.typecode, compress(values, keep)) for column, values in data.items()}
+        return data
+
+    def report(self, since=None, top=20, min_answers=5) -> dict:
+        data = self.columns(since)
+        return {
+            "answers": len(data["time"]),
+            "users": len(set(data["user"])),
+            "hardest_idioms": idiom_error_rates(data, top, min_answers),
+            "level_accuracy": level_accuracy(data),
+            "retention": retention_curve(data),
+        }
+
+    def stats(self) -> dict:
+        with self._locked():
+            return {"rows": self._rows(), "appended": self.appended}
+
+    def close(self):
+        with self._lock:
+            for file in self._files.values():
+                file.close()
+            self._lock_file.close()
+
+@shared
+def get_answer_log():
+    return AnswerLog(ANSWER_LOG_PATH) if ANSWER_LOG_PATH else None
+
+def idiom_error_rates(data: dict, top=20, min_answers=5) -> list[dict]:
+    """The `top` idioms with the highest error rates among those answered at least `min_answers` times"""
+    rates = ratio_by(data["idiom"], data["correct"])
+    hardest = heapq.nlargest(
+        top, ((1 - accuracy, count, idiom) for idiom, (count, accuracy) in rates.items() if count >= min_answers)
+    )
+    bank = get_question_bank()
+    return [
+        {"idiom": bank.idiom_text(idiom) or f"#{idiom}", "answers": count, "error_rate": round(error_rate, 4)}
+        for error_rate, count, idiom in hardest
+    ]
+
+def level_accuracy(data: dict) -> dict:
+    levels = {code: level or "unknown" for level, code in LEVEL_CODES.items()}
+    return {
+        levels.get(code, "unknown"): {"answers": count, "accuracy": round(accuracy, 4)}
+        for code, (count, accuracy) in sorted(ratio_by(data["level"], data["correct"]).items())
+    }
+
+def retention_curve(data: dict) -> list[dict]:
+    """Accuracy of repeat answers by time since the idiom was last answered"""
+    reviews = bytes(map(operator.le, repeat(0.0), data["gap"]))
+    bounds = [bound for bound, _ in RETENTION_BUCKETS]
+    buckets = list(map(bisect.bisect_right, repeat(bounds), compress(data["gap"], reviews)))
+    rates = ratio_by(buckets, bytes(compress(data["correct"], reviews)))
+    return [
+        {"since_last_seen": label, "answers": rates[index][0], "accuracy": round(rates[index][1], 4)}
+        for index, (_, label) in enumerate(RETENTION_BUCKETS) if index in rates
+    ]
+
+def rebuild_answer_log(log: AnswerLog, store: UserStore, batch_size=10000) -> int:
+    """
+    Rebuild the log from the user store's answer history (with each user's current level), returns the events written.
+    The new log is written to a sibling directory and only replaces the old one once it is complete, keeping the
+    anonymous answers the store never saw and any answer logged after the newest one the store returned.
+    """
+    if not store.keeps_answer_history:
+        raise ValueError(f"{type(store).__name__} doesn't keep an answer history")
+    bank = get_question_bank()
+    rebuilt_path = f"{log.path}.rebuild"
+    shutil.rmtree(rebuilt_path, ignore_errors=True)
+    rebuilt = AnswerLog(rebuilt_path)
+    idiom_ids, last_seen, events, written, newest = {}, {}, [], 0, float("-inf")
+    try:
+        for user, idiom, correct, answered_at, level in store.answer_events():
+            if idiom not in idiom_ids:
+                idiom_ids[idiom] = bank.idiom_id(idiom)
+            when, key = timestamp(answered_at), (user, idiom_ids[idiom])
+            events.append((when, user, idiom_ids[idiom], level, correct, when - last_seen[key] if key in last_seen else -1.0))
+            last_seen[key] = when
+            newest = max(newest, when)
+            if len(events) >= batch_size:
+                rebuilt.append(events)
+                written += len(events)
+                events = []
+        rebuilt.append(events)
+        written += len(events)
+        anonymous = user_hash("")
+        # Answer times are stored to the microsecond, the log keeps the exact float
+        log.replace_with(rebuilt, lambda when, user: user == anonymous or when > newest + 1e-3)
+    finally:
+        rebuilt.close()
+        shutil.rmtree(rebuilt_path, ignore_errors=True)
+        with suppress(FileNotFoundError):
+            os.remove(f"{rebuilt_path}.lock")
+    return written
+
+## Response Cache
+
+"""
+Explanations and lookups are the same for every learner, so `explain_last_question` and
+`lookup_idiom` go through a two-tier cache: an in-process LRU with a TTL in front of an
+optional SQLite store shared across sessions. Keys combine the tool, the normalized query
+and a hash of the tool's system prompt, so editing a prompt automatically stops old answers
+from being served. When the cache opens, rows made with an old prompt and rows past the TTL are
+deleted from disk, so the file doesn't keep growing. Empty replies are never cached.
+"""
+
+EXPLAIN_IDIOM_PROMPT = "Explain this English idiom simply and clearly, including an example sentence."
+LOOKUP_IDIOM_PROMPT = "If the user provides a situation, suggest a relevant English idiom. If the user provides an idiom, explain it simply and clearly with an example."
+
+RESPONSE_CACHE_SIZE = int(os.getenv('IDIOMATIC_RESPONSE_CACHE_SIZE', 1024))     # entries kept in memory
+RESPONSE_CACHE_TTL = float(os.getenv('IDIOMATIC_RESPONSE_CACHE_TTL', 7 * 86400))  # seconds
+RESPONSE_CACHE_PATH = os.getenv('IDIOMATIC_RESPONSE_CACHE', 'response_cache.db')  # empty string disables the disk tier
+RESPONSE_PROMPTS = {"explain": EXPLAIN_IDIOM_PROMPT, "lookup": LOOKUP_IDIOM_PROMPT}  # current prompt of each kind
+
+def prompt_version(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode()).hexdigest()[:12]
+
+class ResponseCache:
+    """LRU + TTL cache of model responses, optionally backed by SQLite"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS responses (
+            kind TEXT NOT NULL,
+            version TEXT NOT NULL,
+            query_key TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (kind, version, query_key)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, max_size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, path=RESPONSE_CACHE_PATH,
+                 prompts=RESPONSE_PROMPTS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()  # (kind, version, query_key) -> (created_at, response)
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            with self._lock, self._conn:
+                self._conn.executescript(self.SCHEMA)
+            self.purge_expired()
+            for kind, prompt in prompts.items():
+                self.purge_stale(kind, prompt)
+
+    @staticmethod
+    def _key(kind: str, query: str, prompt: str):
+        return kind, prompt_version(prompt), normalize_idiom(query)
+
+    def get(self, kind: str, query: str, prompt: str):
+        """Cached response for the query under the current prompt, or None"""
+        key = self._key(kind, query, prompt)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[0] < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.memory_hits += 1
+                    metrics.inc("idiomatic_cache_lookups_total", cache="response", result="memory_hit")
+                    return entry[1]
+                del self._entries[key]
+                self.expirations += 1
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT created_at, response FROM responses WHERE kind = ? AND version = ? AND query_key = ?", key
+                ).fetchone()
+                if row is not None and now - row[0] < self.ttl:
+                    self._remember(key, row[0], row[1])
+                    self.disk_hits += 1
+                    metrics.inc("idiomatic_cache_lookups_total", cache="response", result="disk_hit")
+                    return row[1]
+            self.misses += 1
+            metrics.inc("idiomatic_cache_lookups_total", cache="response", result="miss")
+            return None
+
+    def put(self, kind: str, query: str, prompt: str, response: str):
+        if not response:
+            return
+        key = self._key(kind, query, prompt)
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, response)
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO responses (kind, version, query_key, response, created_at) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (*key, response, now),
+                    )
+
+    def _remember(self, key, created_at: float, response: str):
+        self._entries[key] = (created_at, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, kind=None):
+        """Drop every entry, or only those for one kind of response"""
+        with self._lock:
+            for key in [key for key in self._entries if kind is None or key[0] == kind]:
+                del self._entries[key]
+            if self._conn is not None:
+                with self._conn:
+                    if kind is None:
+                        self._conn.execute("DELETE FROM responses")
+                    else:
+                        self._conn.execute("DELETE FROM responses WHERE kind = ?", (kind,))
+
+    def purge_expired(self):
+        """Drop entries older than the TTL"""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            for key in [key for key, (created_at, _) in self._entries.items() if created_at < cutoff]:
+                del self._entries[key]
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute("DELETE FROM responses WHERE created_at < ?", (cutoff,))
+
+    def purge_stale(self, kind: str, prompt: str):
+        """Drop entries of a kind that were made with any prompt other than the current one"""
+        version = prompt_version(prompt)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == kind and key[1] != version]:
+                del self._entries[key]
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute("DELETE FROM responses WHERE kind = ? AND version != ?", (kind, version))
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+get_response_cache = shared(ResponseCache)
+
+
+## Session Checkpoints
+
+"""
+Sessions are checkpointed to SQLite after every node, so a crashed terminal session or server
+process picks up where it stopped. Like LangGraph's in-memory saver, a checkpoint only stores
+the channels a node changed (one blob per channel version) and points at older blobs for the
+rest. List channels that grow by appending (`ITEMIZED_CHANNELS`, the messages) go further: each
+element is stored once, keyed by a digest of its serialized form, and a new version of the
+channel is just its list of digests, so a step writes the messages it added rather than the
+whole conversation again. The rest of a checkpoint row is LangGraph's bookkeeping (which
+version of every channel each node has seen); its version strings are kept short, it is
+zlib-compressed, the channel versions are stored once, and the per-step `writes` LangGraph
+copies into the metadata are left out (they are the pending writes of the parent checkpoint). Only the newest CHECKPOINT_KEEP checkpoints of
+a session are kept, with the blobs and items they no longer reference. Together with the compact
+state this keeps write volume per turn flat however long a session runs.
+`IDIOMATIC_CHECKPOINTS=` (empty) keeps checkpoints in memory only.
+"""
+
+CHECKPOINT_PATH = os.getenv('IDIOMATIC_CHECKPOINTS', 'sessions.db')
+CHECKPOINT_KEEP = int(os.getenv('IDIOMATIC_CHECKPOINT_KEEP', 2))  # checkpoints kept per session
+
+class SqliteCheckpointer(BaseCheckpointSaver):
+    """LangGraph checkpointer writing per-channel deltas to WAL-mode SQLite"""
+
+    ITEMIZED_CHANNELS = ("messages",)
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            thread_id TEXT NOT NULL,
+            checkpoint_ns TEXT NOT NULL,
+            checkpoint_id TEXT NOT NULL,
+            parent_id TEXT,
+            versions BLOB NOT NULL,
+            type TEXT NOT NULL,
+            checkpoint BLOB NOT NULL,
+            metadata_type TEXT NOT NULL,
+            metadata BLOB NOT NULL,
+            PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS blobs (
+            thread_id TEXT NOT NULL,
+            checkpoint_ns TEXT NOT NULL,
+            channel TEXT NOT NULL,
+            version TEXT NOT NULL,
+            type TEXT NOT NULL,
+            value BLOB,
+            PRIMARY KEY (thread_id, checkpoint_ns, channel, version)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS writes (
+            thread_id TEXT NOT NULL,
+            checkpoint_ns TEXT NOT NULL,
+            checkpoint_id TEXT NOT NULL,
+            task_id TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            channel TEXT NOT NULL,
+            type TEXT NOT NULL,
+            value BLOB,
+            task_path TEXT NOT NULL,
+            PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS items (
+            thread_id TEXT NOT NULL,
+            checkpoint_ns TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            type TEXT NOT NULL,
+            value BLOB,
+            PRIMARY KEY (thread_id, checkpoint_ns, digest)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path=CHECKPOINT_PATH, keep=CHECKPOINT_KEEP):
+        super().__init__()
+        self.keep = keep
+        self.puts = 0
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._lock, self._conn:
+            self._conn.executescript(self.SCHEMA)
+
+    def _tuple(self, thread_id: str, checkpoint_ns: str, row) -> CheckpointTuple:
+        """Assemble a checkpoint from its row, the blobs of its channel versions and its pending writes (caller holds the lock)"""
+        checkpoint_id, parent_id, versions, type_, checkpoint, metadata_type, metadata = row
+        versions = self._versions(versions)
+        checkpoint = {**self.serde.loads_typed(self._unpack(type_, checkpoint)), "channel_versions": versions}
+        values = {}
+        for channel, version in versions.items():
+            blob = self._conn.execute(
+                "SELECT type, value FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version = ?",
+                (thread_id, checkpoint_ns, channel, version),
+            ).fetchone()
+            if blob is None or blob[0] == "empty":
+                continue
+            if blob[0] == "items":
+                values[channel] = self._load_items(thread_id, checkpoint_ns, json.loads(blob[1]))
+            else:
+                values[channel] = self.serde.loads_typed(tuple(blob))
+        writes = self._conn.execute(
+            "SELECT task_id, channel, type, value FROM writes "
+            "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ).fetchall()
+        config = lambda id_: {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": id_}}
+        return CheckpointTuple(
+            config=config(checkpoint_id),
+            checkpoint={**checkpoint, "channel_values": values},
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            parent_config=config(parent_id) if parent_id else None,
+            pending_writes=[(task_id, channel, self.serde.loads_typed((type_, value))) for task_id, channel, type_, value in writes],
+        )
+
+    @staticmethod
+    def _pack(type_: str, serialized: bytes) -> tuple[str, bytes]:
+        return f"{type_}+zlib", zlib.compress(serialized)
+
+    @staticmethod
+    def _unpack(type_: str, serialized: bytes) -> tuple[str, bytes]:
+        return type_.removesuffix("+zlib"), zlib.decompress(serialized)
+
+    @staticmethod
+    def _versions(versions: bytes) -> dict:
+        return json.loads(zlib.decompress(versions))
+
+    def _load_items(self, thread_id: str, checkpoint_ns: str, digests: list) -> list:
+        """The elements of an itemized channel value, in order (caller holds the lock)"""
+        items = {}
+        for start in range(0, len(digests), 500):
+            batch = digests[start:start + 500]
+            items.update((digest, (type_, value)) for digest, type_, value in self._conn.execute(
+                f"SELECT digest, type, value FROM items WHERE thread_id = ? AND checkpoint_ns = ? "
+                f"AND digest IN ({', '.join('?' * len(batch))})", (thread_id, checkpoint_ns, *batch),
+            ))
+        return [self.serde.loads_typed(items[digest]) for digest in digests]
+
+    def _dump_items(self, thread_id: str, checkpoint_ns: str, value: list) -> tuple[tuple, list]:
+        """An itemized channel value as a blob of element digests, plus the rows of its elements"""
+        digests, rows = [], []
+        for element in value:
+            type_, serialized = self.serde.dumps_typed(element)
+            digest = hashlib.blake2b(type_.encode() + b"\0" + serialized, digest_size=8).hexdigest()
+            digests.append(digest)
+            rows.append((thread_id, checkpoint_ns, digest, type_, serialized))
+        return ("items", json.dumps(digests).encode()), rows
+
+    def get_tuple(self, config) -> CheckpointTuple | None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        query = (
+            "SELECT checkpoint_id, parent_id, versions, type, checkpoint, metadata_type, metadata FROM checkpoints "
+            "WHERE thread_id = ? AND checkpoint_ns = ?"
+        )
+        with self._lock:
+            if checkpoint_id := get_checkpoint_id(config):
+                row = self._conn.execute(query + " AND checkpoint_id = ?", (thread_id, checkpoint_ns, checkpoint_id)).fetchone()
+            else:
+                row = self._conn.execute(query + " ORDER BY checkpoint_id DESC LIMIT 1", (thread_id, checkpoint_ns)).fetchone()
+            return self._tuple(thread_id, checkpoint_ns, row) if row else None
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        query = "SELECT thread_id, checkpoint_ns, checkpoint_id, parent_id, versions, type, checkpoint, metadata_type, metadata FROM checkpoints"
+        clauses, params = [], []
+        if config:
+            clauses.append("thread_id = ?")
+            params.append(config["configurable"]["thread_id"])
+            if config["configurable"].get("checkpoint_ns") is not None:
+                clauses.append("checkpoint_ns = ?")
+                params.append(config["configurable"]["checkpoint_ns"])
+            if checkpoint_id := get_checkpoint_id(config):
+                clauses.append("checkpoint_id = ?")
+                params.append(checkpoint_id)
+        if before and (before_id := get_checkpoint_id(before)):
+            clauses.append("checkpoint_id < ?")
+            params.append(before_id)
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY checkpoint_id DESC", params).fetchall()
+        for thread_id, checkpoint_ns, *row in rows:
+            if limit is not None and limit <= 0:
+                break
+            with self._lock:
+                checkpoint = self._tuple(thread_id, checkpoint_ns, row)
+            if filter and not all(checkpoint.metadata.get(key) == value for key, value in filter.items()):
+                continue
+            if limit is not None:
+                limit -= 1
+            yield checkpoint
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        checkpoint = checkpoint.copy()
+        values = checkpoint.pop("channel_values")
+        versions = checkpoint.pop("channel_versions")
+        # Only the channels this step changed get a new blob, the rest are shared with earlier checkpoints
+        blobs, items = [], []
+        for channel, version in new_versions.items():
+            if channel not in values:
+                blob = ("empty", None)
+            elif channel in self.ITEMIZED_CHANNELS and isinstance(values[channel], list):
+                blob, rows = self._dump_items(thread_id, checkpoint_ns, values[channel])
+                items.extend(rows)
+            else:
+                blob = self.serde.dumps_typed(values[channel])
+            blobs.append((thread_id, checkpoint_ns, channel, version, *blob))
+        type_, serialized = self._pack(*self.serde.dumps_typed(checkpoint))
+        metadata = {key: value for key, value in get_checkpoint_metadata(config, metadata).items() if key != "writes"}
+        metadata_type, serialized_metadata = self.serde.dumps_typed(metadata)
+        row = (thread_id, checkpoint_ns, checkpoint["id"], config["configurable"].get("checkpoint_id"),
+               zlib.compress(json.dumps(versions).encode()), type_, serialized, metadata_type, serialized_metadata)
+        size = sum(len(blob[5] or b"") for blob in blobs) + len(row[4]) + len(serialized) + len(serialized_metadata)
+        with self._lock, self._conn:
+            # Elements already stored for the session (earlier messages) are not written again
+            for item in items:
+                if self._conn.execute("INSERT OR IGNORE INTO items VALUES (?, ?, ?, ?, ?)", item).rowcount:
+                    size += len(item[4])
+            self._conn.executemany("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?, ?)", blobs)
+            self._conn.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+            self._prune(thread_id, checkpoint_ns)
+            self.puts += 1
+            self.bytes_written += size
+        metrics.inc("idiomatic_checkpoint_bytes_total", size)
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}}
+
+    def _prune(self, thread_id: str, checkpoint_ns: str):
+        """Drop all but the newest `keep` checkpoints of a thread, and blobs none of those reference (caller holds the lock)"""
+        kept = self._conn.execute(
+            "SELECT checkpoint_id, versions FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+            "ORDER BY checkpoint_id DESC LIMIT ?", (thread_id, checkpoint_ns, self.keep),
+        ).fetchall()
+        if len(kept) < self.keep:
+            return
+        oldest = kept[-1][0]
+        key = (thread_id, checkpoint_ns, oldest)
+        self._conn.execute("DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id < ?", key)
+        self._conn.execute("DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id < ?", key)
+        # Versions only grow, so a blob older than every kept checkpoint's version of its channel is unreachable
+        oldest_versions = {}
+        for _, versions in kept:
+            for channel, version in self._versions(versions).items():
+                oldest_versions[channel] = min(version, oldest_versions.get(channel, version))
+        self._conn.executemany(
+            "DELETE FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND channel = ? AND version < ?",
+            [(thread_id, checkpoint_ns, channel, version) for channel, version in oldest_versions.items()],
+        )
+        self._conn.execute(
+            f"DELETE FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND channel NOT IN ({', '.join('?' * len(oldest_versions))})",
+            (thread_id, checkpoint_ns, *oldest_versions),
+        )
+        # Items are shared between versions, keep those some remaining blob still lists
+        referenced = set()
+        for (digests,) in self._conn.execute(
+            "SELECT value FROM blobs WHERE thread_id = ? AND checkpoint_ns = ? AND type = 'items'", (thread_id, checkpoint_ns)
+        ):
+            referenced.update(json.loads(digests))
+        stored = [digest for (digest,) in self._conn.execute(
+            "SELECT digest FROM items WHERE thread_id = ? AND checkpoint_ns = ?", (thread_id, checkpoint_ns)
+        )]
+        self._conn.executemany(
+            "DELETE FROM items WHERE thread_id = ? AND checkpoint_ns = ? AND digest = ?",
+            [(thread_id, checkpoint_ns, digest) for digest in stored if digest not in referenced],
+        )
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        rows = [
+            (thread_id, checkpoint_ns, checkpoint_id, task_id, WRITES_IDX_MAP.get(channel, index), channel,
+             *self.serde.dumps_typed(value), task_path)
+            for index, (channel, value) in enumerate(writes)
+        ]
+        size = sum(len(row[7] or b"") for row in rows)
+        with self._lock, self._conn:
+            # Special writes (errors, interrupts) are replaced, regular ones are written once per task
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [row for row in rows if row[4] < 0]
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [row for row in rows if row[4] >= 0]
+            )
+            self.bytes_written += size
+        metrics.inc("idiomatic_checkpoint_bytes_total", size)
+
+    def delete_thread(self, thread_id: str):
+        with self._lock, self._conn:
+            for table in ("checkpoints", "blobs", "writes", "items"):
+                self._conn.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+
+    async def aget_tuple(self, config):
+        return self.get_tuple(config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        for checkpoint in self.list(config, filter=filter, before=before, limit=limit):
+            yield checkpoint
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return self.put(config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        return self.put_writes(config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str):
+        return self.delete_thread(thread_id)
+
+    def get_next_version(self, current, channel) -> str:
+        # The in-memory saver's scheme, shortened: zero-padded so versions compare as strings. Every
+        # checkpoint lists each channel's version (twice, with versions_seen), so length adds up.
+        current = 0 if current is None else current if isinstance(current, int) else int(current.split(".")[0])
+        return f"{current + 1:010}.{random.randrange(1 << 24):06x}"
+
+    def stats(self) -> dict:
+        with self._lock:
+            sessions = self._conn.execute("SELECT COUNT(DISTINCT thread_id) FROM checkpoints").fetchone()[0]
+            return {"puts": self.puts, "bytes_written": self.bytes_written, "sessions": sessions}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def make_checkpointer(path=CHECKPOINT_PATH):
+    """SQLite checkpointer, or LangGraph's in-memory one when no path is configured"""
+    return SqliteCheckpointer(path) if path else MemorySaver()
+
+get_checkpointer = shared(make_checkpointer)
 
 
 ## Tools
 
+def message_text(message) -> str:
+    content = message.content
+    if isinstance(content, str):
+        return content
+    return "".join(part if isinstance(part, str) else part.get("text", "") for part in content)
+
+def reply(kind: str, llm, messages: list, prefix: str = "") -> tuple[AIMessage, bool]:
+    """Get a chat model reply, streaming its text to the learner (led by `prefix`) when streaming is on.
+    Returns the reply and whether it was shown."""
+    if not STREAM_RESPONSES:
+        return model_call(kind, llm.invoke, messages), False
+    chunks = []
+    def pieces():
+        for chunk in model_stream(kind, llm.stream, messages):
+            chunks.append(chunk)
+            yield message_text(chunk)
+    shown = bool(render_stream(pieces(), prefix))
+    if not chunks:
+        return AIMessage(content=""), False
+    return message_chunk_to_message(functools.reduce(lambda a, b: a + b, chunks)), shown
+
 @tool
 def show_score(score: int) -> str:
     """Show the user's current quiz score."""
     return f"📈 Your score is {score}."
 
-@tool
-def explain_last_question(idiom: str) -> str:
+# explain/lookup stream fresh answers straight to the learner; the artifact says whether they were shown
+@tool(response_format="content_and_artifact")
+def explain_last_question(idiom: str) -> tuple[str, dict]:
     """Explain the last idiom that was part of a question."""
-    print(f"--- Explaining Idiom: {idiom} ---")
-    try:
-        response = llm.invoke([
-            SystemMessage(content="Explain this English idiom simply and clearly, including an example sentence."),
-            HumanMessage(content=idiom)
-        ])
-        explanation = response.content.strip()
-        return f"**Explanation for '{idiom}':**\n{explanation}"
-    except Exception as e:
-        print(f"Error invoking LLM for explanation: {e}")
-        return f"Sorry, I couldn't generate an explanation for '{idiom}' right now."
-
-@tool
-def lookup_idiom(query: str) -> str:
+    logger.debug("Explaining Idiom: %s", idiom)
+    header = f"**Explanation for '{idiom}':**\n"
+    explanation = get_response_cache().get("explain", idiom, EXPLAIN_IDIOM_PROMPT)
+    shown = False
+    if explanation is None:
+        try:
+            response, shown = reply("explain", get_llm(), [
+                SystemMessage(content=EXPLAIN_IDIOM_PROMPT),
+                HumanMessage(content=idiom)
+            ], prefix=f"**Idiomatic:** {header}")
+            explanation = message_text(response).strip()
+            if not explanation:
+                raise ValueError("empty reply")
+            get_response_cache().put("explain", idiom, EXPLAIN_IDIOM_PROMPT, explanation)
+        except Exception as e:
+            logger.error("Error invoking LLM for explanation: %s", e)
+            return f"Sorry, I couldn't generate an explanation for '{idiom}' right now.", {"shown": False}
+    return header + explanation, {"shown": shown}
+
+@tool(response_format="content_and_artifact")
+def lookup_idiom(query: str) -> tuple[str, dict]:
     """Find a natural idiom for a given user query/context or explain a requested idiom."""
-    print(f"--- Looking up/Explaining Idiom from query: {query} ---")
-    try:
-        # Ask the LLM to either find an idiom for the context OR explain the idiom if the query *is* an idiom
-        response = llm.invoke([
-            SystemMessage(content="If the user provides a situation, suggest a relevant English idiom. If the user provides an idiom, explain it simply and clearly with an example."),
-            HumanMessage(content=query)
-        ])
-        result = response.content.strip()
-        return f"**Regarding '{query}':**\n{result}"
-    except Exception as e:
-         print(f"Error invoking LLM for lookup/explanation: {e}")
-         return f"Sorry, I couldn't process your request for '{query}' right now."
+    logger.debug("Looking up/Explaining Idiom from query: %s", query)
+    header = f"**Regarding '{query}':**\n"
+    result = get_response_cache().get("lookup", query, LOOKUP_IDIOM_PROMPT)
+    shown = False
+    if result is None:
+        try:
+            # Ask the LLM to either find an idiom for the context OR explain the idiom if the query *is* an idiom
+            response, shown = reply("lookup", get_llm(), [
+                SystemMessage(content=LOOKUP_IDIOM_PROMPT),
+                HumanMessage(content=query)
+            ], prefix=f"**Idiomatic:** {header}")
+            result = message_text(response).strip()
+            if not result:
+                raise ValueError("empty reply")
+            get_response_cache().put("lookup", query, LOOKUP_IDIOM_PROMPT, result)
+        except Exception as e:
+             logger.error("Error invoking LLM for lookup/explanation: %s", e)
+             return f"Sorry, I couldn't process your request for '{query}' right now.", {"shown": False}
+    return header + result, {"shown": shown}
 
 @tool
 def quit_session() -> str:
     """Quit the session and signal to end the application."""
-    print("--- Quitting Session ---")
+    logger.debug("Quitting Session")
     # This message signals the graph to terminate.
     # The chatbot node will detect this specific message from the ToolNode.
     return "QUIT_SESSION_SIGNAL"
 
 tools = [show_score, explain_last_question, lookup_idiom, quit_session]
-tool_node = ToolNode(tools)
-llm_with_tools = llm.bind_tools(tools)
 
 
 ## Orchestration LLM & Routing
@@ -271,235 +2674,895 @@ IDIOMATIC_BOT_SYSINT = (
   "Current Score: {score}. Last Question Idiom: {last_idiom}."
 )
 
+## Intent Fast Path
+
+"""
+Most commands are unambiguous ("score", "quit", "explain", "what does X mean?"), and sending
+them through the orchestration LLM costs two model round trips before the tool even runs. A
+few local rules catch these, call the tool directly with the real score / last idiom, and show
+its result verbatim. Anything the rules aren't sure about still goes to the LLM, including
+lookups of a single unquoted word ("what does this mean", "define love"), which are rarely
+idioms, and "meaning of ...", which is as often a question as a lookup.
+"""
+
+FAST_PATH_MIN_CONFIDENCE = 0.9
+FAST_PATH_ID_PREFIX = "fastpath_"
+
+INTENT_RULES = [
+    # (tool, confidence, pattern)
+    ("quit_session", 1.0, re.compile(r"^(?:quit|exit|stop|bye|goodbye|i'?m done|end(?: the)? session)$")),
+    ("show_score", 1.0, re.compile(r"^(?:score|my score|show(?: me)?(?: my)? score|what'?s my score|what is my score|how am i doing)$")),
+    ("explain_last_question", 0.95, re.compile(r"^(?:explain(?: that| it| this| the last(?: one| question| idiom)?)?|why|what does (?:that|it|this) mean)$")),
+    ("lookup_idiom", 0.9, re.compile(r"^(?:look ?up|define) (?P<query>.+)$|^what does (?P<meaning>.+) mean$")),
+    ("lookup_idiom", 0.7, re.compile(r"^meaning of (?P<query>.+)$")),
+]
+
+def idiom_query(query: str) -> str | None:
+    """The query to look up if it is quoted or several words long (idioms are), else None"""
+    query = query.strip()
+    quoted = len(query) > 2 and query[0] == query[-1] and query[0] in "'\""
+    query = query.strip(" '\"")
+    return query if quoted or " " in query else None
+
+def classify_intent(text: str, state: IdiomaticState):
+    """Match input against INTENT_RULES, returning (tool, args, confidence) or None"""
+    text = re.sub(r"\s+", " ", text.strip().lower().replace("\u2019", "'")).rstrip(" ?!.")
+    for tool_name, confidence, pattern in INTENT_RULES:
+        match = pattern.match(text)
+        if not match:
+            continue
+        if tool_name == "show_score":
+            return tool_name, {"score": state.get("score", 0)}, confidence
+        if tool_name == "explain_last_question":
+            if not state.get("last_question"):
+                return None  # nothing to explain yet, let the LLM answer
+            return tool_name, {"idiom": state["last_question"]["idiom"]}, confidence
+        if tool_name == "lookup_idiom":
+            query = idiom_query(match.group("query") or match.group("meaning"))
+            if query is None:
+                return None  # a single word, let the LLM decide what is being asked
+            return tool_name, {"query": query}, confidence
+        return tool_name, {}, confidence
+    return None
+
+## Conversation Window
+
+"""
+`add_messages` only ever grows the history, so sending all of it to the orchestration LLM makes
+every turn slower and more expensive than the last. Instead we send the last few turns verbatim
+(within a token budget), fold older turns into a short rolling summary that rides along in the
+system prompt, and leave quiz answers and results out entirely since the LLM never needs them.
+"""
+
+CONTEXT_RECENT_TURNS = int(os.getenv('IDIOMATIC_CONTEXT_TURNS', 6))            # turns kept verbatim
+CONTEXT_TOKEN_BUDGET = int(os.getenv('IDIOMATIC_CONTEXT_TOKEN_BUDGET', 2000))  # for the verbatim turns
+SUMMARY_MAX_CHARS = 1200
+SUMMARY_LINE_CHARS = 120
+STATE_MAX_MESSAGES = int(os.getenv('IDIOMATIC_STATE_MAX_MESSAGES', 24))  # messages held before old ones are dropped
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token), good enough for budgeting"""
+    return len(text) // 4 + 1
+
+def is_quiz_message(message) -> bool:
+    if isinstance(message, HumanMessage):
+        return message.content.strip().lower() in QUIZ_ANSWERS
+    return getattr(message, "name", None) == QUIZ_MESSAGE_NAME
+
+def split_turns(messages: list) -> list[list]:
+    """Group messages into turns, each starting with a human message (tool calls stay with their results)"""
+    turns = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+def summarize_turn(turn: list) -> str:
+    clip = lambda text: text if len(text) <= SUMMARY_LINE_CHARS else text[:SUMMARY_LINE_CHARS - 3] + "..."
+    parts = []
+    for message in turn:
+        if isinstance(message, HumanMessage):
+            parts.append(f"User: {clip(message.content)}")
+        elif isinstance(message, AIMessage) and message.tool_calls:
+            parts.append("called " + ", ".join(call["name"] for call in message.tool_calls))
+        elif isinstance(message, AIMessage) and message.content:
+            parts.append(f"Idiomatic: {clip(message.content)}")
+    return "; ".join(parts)
+
+def build_context(state: IdiomaticState) -> tuple[list, str, str]:
+    """Messages to send verbatim, plus the updated rolling summary and summary cursor"""
+    turns = split_turns([message for message in state["messages"] if not is_quiz_message(message)])
+    recent = turns[-CONTEXT_RECENT_TURNS:]
+    # Drop the oldest kept turns until they fit the budget, but always keep the latest one
+    while len(recent) > 1 and sum(estimate_tokens(str(m.content)) for turn in recent for m in turn) > CONTEXT_TOKEN_BUDGET:
+        recent = recent[1:]
+    older = turns[:len(turns) - len(recent)]
+
+    summary = state.get("conversation_summary") or ""
+    cursor = state.get("summary_cursor") or ""
+    # Only turns after the cursor are new to the summary
+    start = 0
+    for index, turn in enumerate(older):
+        if cursor and any(message.id == cursor for message in turn):
+            start = index + 1
+    new_lines = [line for line in map(summarize_turn, older[start:]) if line]
+    if new_lines:
+        summary = "\n".join(filter(None, [summary] + new_lines))
+        if len(summary) > SUMMARY_MAX_CHARS:
+            # Rolling: keep the most recent part of the summary
+            summary = summary[-SUMMARY_MAX_CHARS:].split("\n", 1)[-1]
+    if older:
+        cursor = older[-1][-1].id or cursor
+    return [message for turn in recent for message in turn], summary, cursor
+
+def compact_messages(state: IdiomaticState) -> dict:
+    """Fold turns outside the context window into the summary and remove them, along with old quiz
+    results, from the state. The last couple of messages stay, routing looks at them."""
+    context, summary, cursor = build_context(state)
+    keep = {message.id for message in context + state["messages"][-2:]}
+    return {
+        "conversation_summary": summary,
+        "summary_cursor": cursor,
+        "messages": [RemoveMessage(id=message.id) for message in state["messages"] if message.id not in keep],
+    }
+
 def chatbot_node(state: IdiomaticState) -> IdiomaticState:
     """Handles initial setup, invokes LLM for routing/chat/tools, and checks for quit signal."""
 
     # 1. Initial Setup (if name is not set)
     if not state.get("name"):
-        print("--- Initial Setup ---")
-        # Use input() for Colab/terminal interaction
-        user_name = input("👋 Welcome to Idiomatic! What's your name? ")
-        level_choice = input("Skill level (a) beginner / (b) intermediate / (c) advanced: ").strip().lower()
+        logger.debug("Initial Setup")
+        # read_input() stops the graph until the terminal or server resumes it with a reply
+        user_name = read_input("👋 Welcome to Idiomatic! What's your name? ")
+        level_choice = read_input("Skill level (a) beginner / (b) intermediate / (c) advanced: ").strip().lower()
         # Map choice to a descriptive level
         level_map = {'a': 'beginner', 'b': 'intermediate', 'c': 'advanced'}
         level = level_map.get(level_choice, 'intermediate') # Default to intermediate
 
-        category = input(f"Preferred idiom category (e.g., business, animals, food) [default: general]: ") or "general"
+        category = read_input(f"Preferred idiom category (e.g., business, animals, food) [default: general]: ") or "general"
 
-        state.update({
+        # Pick up where a returning user left off
+        user_data = get_user_store().load_user(user_name)
+        bank = get_question_bank()
+        welcome = AIMessage(content=f"Hello {user_name}! 👋 Let's start with some {category} idioms at the {level} level. I'll ask you multiple-choice questions. You can also ask me to 'explain', show your 'score', 'lookup' an idiom, or 'quit'.")
+        update = {
             "name": user_name,
             "user_level": level,
             "category": category,
-            "messages": [AIMessage(content=f"Hello {user_name}! 👋 Let's start with some {category} idioms at the {level} level. I'll ask you multiple-choice questions. You can also ask me to 'explain', show your 'score', 'lookup' an idiom, or 'quit'.")] # Initial message
-        })
-        display(Markdown(state['messages'][-1].content))
+            "score": user_data["score"],
+            "history": [bank.idiom_id(idiom) for idiom in user_data["history"][-HISTORY_LENGTH:]],
+            "review_queue": load_review_queue(user_name),
+            "messages": [welcome],
+        }
+        get_user_store().save_profile(update)
+        render(welcome.content)
         # Initial state setup complete, next node should be 'generate_question'
         # We'll handle this transition in the routing logic.
-        return state # Return immediately after setup
+        return update # Return immediately after setup
 
     # 2. Process Last Message (Tool Result or Human Input)
     last_message = state["messages"][-1] if state["messages"] else None
 
     # Check if the last message is a ToolMessage with the quit signal
     if isinstance(last_message, ToolMessage) and last_message.content == "QUIT_SESSION_SIGNAL":
-        print("--- Quit Signal Received ---")
+        logger.debug("Quit Signal Received")
         final_message = "👋 Thanks for learning with Idiomatic! Your progress is saved."
-        state["messages"].append(AIMessage(content=final_message))
-        display(Markdown(final_message))
-        state["finished"] = True
-        save_user_data(state) # Save progress on quit
-        return state
+        render(final_message)
+        get_user_store().save_profile(state) # Save progress on quit
+        return {"messages": [AIMessage(content=final_message)], "finished": True}
+
+    # Results of fast-path tool calls are already user-facing, show them without another LLM round trip.
+    # The same goes for any tool result that was streamed to the learner as it was generated.
+    if isinstance(last_message, ToolMessage):
+        shown = bool(last_message.artifact and last_message.artifact.get("shown"))
+        if shown or last_message.tool_call_id.startswith(FAST_PATH_ID_PREFIX):
+            if not shown:
+                render(f"**Idiomatic:** {last_message.content}")
+            return {"messages": [AIMessage(content=last_message.content)]}
+
+    # Unambiguous commands skip the orchestration LLM and call their tool directly
+    if isinstance(last_message, HumanMessage):
+        intent = classify_intent(last_message.content, state)
+        if intent and intent[2] >= FAST_PATH_MIN_CONFIDENCE:
+            tool_name, args, _ = intent
+            logger.debug("Fast Path: %s", tool_name)
+            metrics.inc("idiomatic_fast_path_total", tool=tool_name)
+            return {"messages": [AIMessage(
+                content="",
+                tool_calls=[{"name": tool_name, "args": args, "id": f"{FAST_PATH_ID_PREFIX}{uuid.uuid4().hex}"}],
+            )]}
 
     # If the last message wasn't the quit signal, invoke LLM with history
     # This handles: Tool results (like score/explanation), human commands, or general chat
+    update = {"messages": []}
     try:
-        print("--- Invoking LLM with Tools ---")
-        # Pass score and last_question idiom to the LLM via state implicitly or explicitly in prompt if needed
-        # The LLM already has access to tools that use state elements (score, last_question)
-        response = llm_with_tools.invoke(
-            [SystemMessage(content=IDIOMATIC_BOT_SYSINT)] + state["messages"] # Pass full history
+        logger.debug("Invoking LLM with Tools")
+        last_question = state.get("last_question") or {}
+        system_prompt = IDIOMATIC_BOT_SYSINT.format(
+            score=state.get("score", 0), last_idiom=last_question.get("idiom", "none yet")
+        )
+        # Only a bounded window of recent turns, older ones are summarized
+        context, summary, cursor = build_context(state)
+        update.update(conversation_summary=summary, summary_cursor=cursor)
+        if summary:
+            system_prompt += f"\n\nSummary of earlier conversation:\n{summary}"
+        # Chat replies are streamed as they arrive, tool calls come through in the assembled message
+        response, shown = reply(
+            "orchestrate", get_llm_with_tools(), [SystemMessage(content=system_prompt)] + context, prefix="**Idiomatic:** "
         )
-        state["messages"].append(response)
+        update["messages"].append(response)
 
-        # Display the response unless it contains tool calls (handled by ToolNode)
-        if not response.tool_calls:
-            display(Markdown(f"**Idiomatic:** {response.content}"))
+        # Display the response unless it was streamed or contains tool calls (handled by ToolNode)
+        if not response.tool_calls and not shown:
+            render(f"**Idiomatic:** {response.content}")
+
+    except ModelUnavailable as e:
+        logger.warning("Model busy in chatbot_node: %s", e)
+        busy_msg = "I'm a little busy right now, please try again in a moment."
+        update["messages"].append(AIMessage(content=busy_msg))
+        render(busy_msg)
 
     except Exception as e:
-        print(f"Error invoking LLM in chatbot_node: {e}")
+        logger.error("Error invoking LLM in chatbot_node: %s", e)
         # Add an error message to the state
         error_msg = "Sorry, I encountered an error. Please try again."
-        state["messages"].append(AIMessage(content=error_msg))
-        display(Markdown(error_msg))
+        update["messages"].append(AIMessage(content=error_msg))
+        render(error_msg)
 
 
-    return state
+    return update
 
 def get_user_input(state: IdiomaticState) -> IdiomaticState:
     """Prompts the user for input and adds it as a HumanMessage."""
-    print("--- Waiting for User Input ---")
+    logger.debug("Waiting for User Input")
     # Check if the last message was an AIMessage indicating a question was asked
     # or if it was a tool response that requires a follow-up action from the user.
     prompt_message = "Your answer (a/b/c/d) or command: \n"
     # You could customize the prompt based on the last AI message if needed
 
-    user_input = input(prompt_message).strip()
-    state["messages"].append(HumanMessage(content=user_input))
-    return state
+    # Top up the question pool in the background while the user is typing
+    get_question_pool().refill(state["user_level"], state.get("category") or "general")
+    user_input = read_input(prompt_message).strip()
+    update = {"messages": [HumanMessage(content=user_input)]}
+    # Quiz answers never reach the LLM path, so long sessions are trimmed here
+    if len(state["messages"]) > STATE_MAX_MESSAGES:
+        update = compact_messages(state)
+        update["messages"].append(HumanMessage(content=user_input))
+    return update
 
 def route_logic(state: IdiomaticState) -> Literal["tools", "evaluate_quiz", "chatbot_node", "generate_question", "__end__"]:
     """Decides the next step based on the last message."""
-    print(f"--- Routing (Finished: {state.get('finished')}) ---")
+    route = decide_route(state)
+    metrics.inc("idiomatic_routes_total", route=route)
+    return route
+
+def decide_route(state: IdiomaticState) -> str:
+    logger.debug("Routing (Finished: %s)", state.get('finished'))
     if state.get("finished"):
-        print("--- Routing to END ---")
+        logger.debug("Routing to END")
         return END # Use END from langgraph.graph
 
     last_message = state["messages"][-1] if state["messages"] else None
 
     # 1. After Initial Setup -> Generate Question
     if isinstance(last_message, AIMessage) and "Let's start" in last_message.content:
-         print("--- Routing: Initial Setup -> Generate Question ---")
+         logger.debug("Routing: Initial Setup -> Generate Question")
          return "generate_question"
 
     # 2. After LLM response with Tool Calls -> Tools Node
     if isinstance(last_message, AIMessage) and last_message.tool_calls:
-        print("--- Routing: AIMessage with Tool Calls -> Tools Node ---")
+        logger.debug("Routing: AIMessage with Tool Calls -> Tools Node")
         return "tools"
 
     # 3. After Tool Node (which adds ToolMessage) -> Chatbot Node (to process result)
     if isinstance(last_message, ToolMessage):
-         print("--- Routing: ToolMessage -> Chatbot Node ---")
+         logger.debug("Routing: ToolMessage -> Chatbot Node")
          return "chatbot_node" # Chatbot node handles tool results (incl. quit signal)
 
     # 4. After Human provides quiz answer -> Evaluate Quiz
     if isinstance(last_message, HumanMessage):
         content = last_message.content.strip().lower()
-        if content in {"a", "b", "c", "d"} and state.get("last_question"):
-             print("--- Routing: Human Answer -> Evaluate Quiz ---")
+        if content in QUIZ_ANSWERS and state.get("last_question"):
+             logger.debug("Routing: Human Answer -> Evaluate Quiz")
              return "evaluate_quiz"
         else:
              # It's a command or chat -> Chatbot Node (to process with LLM)
-             print("--- Routing: Human Command/Chat -> Chatbot Node ---")
+             logger.debug("Routing: Human Command/Chat -> Chatbot Node")
              return "chatbot_node"
 
     # 5. After evaluation or non-tool AI response -> Generate Question
     # This covers the case after evaluate_quiz adds its result message,
     # or after the chatbot gives an explanation/score/chat response.
     if isinstance(last_message, AIMessage) and not last_message.tool_calls:
-         print("--- Routing: AIMessage (Eval Result/Chat/Explanation) -> Generate Question ---")
+         logger.debug("Routing: AIMessage (Eval Result/Chat/Explanation) -> Generate Question")
          return "generate_question"
 
     # Default fallback (should ideally not be reached often)
-    print("--- Routing: Fallback -> Generate Question (or consider END/error) ---")
+    logger.debug("Routing: Fallback -> Generate Question (or consider END/error)")
     # If unsure, maybe ask a new question? Or prompt user again?
     return "generate_question"
 
-graph_builder = StateGraph(IdiomaticState)
-
-graph_builder.add_node("chatbot_node", chatbot_node)
-graph_builder.add_node("tools", tool_node)
-graph_builder.add_node("generate_question", generate_idiom_question)
-graph_builder.add_node("evaluate_quiz", evaluate_quiz_answer)
-graph_builder.add_node("get_input", get_user_input) # Add the input node
-
-# Entry point is the chatbot node (handles initial setup)
-graph_builder.set_entry_point("chatbot_node")
-
-# Conditional Edges based on Router
-graph_builder.add_conditional_edges(
-    "chatbot_node", # Source node for routing decisions *after* chatbot processes input/tool result
-    route_logic,
-    {
-        "tools": "tools",
-        "generate_question": "generate_question", # Route to generate after setup or tool explanation
-        "chatbot_node": "get_input", # Should not loop back directly, get input first
-         END: END
-    }
-)
+def build_graph(checkpointer=None):
+    """Assemble and compile the agent graph"""
+    graph_builder = StateGraph(IdiomaticState)
+
+    graph_builder.add_node("chatbot_node", instrumented_node("chatbot_node", chatbot_node))
+    graph_builder.add_node("tools", instrumented_node("tools", ToolNode(tools)))
+    graph_builder.add_node("generate_question", instrumented_node("generate_question", generate_idiom_question))
+    graph_builder.add_node("evaluate_quiz", instrumented_node("evaluate_quiz", evaluate_quiz_answer))
+    graph_builder.add_node("get_input", instrumented_node("get_input", get_user_input)) # Add the input node
+
+    # Entry point is the chatbot node (handles initial setup)
+    graph_builder.set_entry_point("chatbot_node")
+
+    # Conditional Edges based on Router
+    graph_builder.add_conditional_edges(
+        "chatbot_node", # Source node for routing decisions *after* chatbot processes input/tool result
+        route_logic,
+        {
+            "tools": "tools",
+            "generate_question": "generate_question", # Route to generate after setup or tool explanation
+            "chatbot_node": "get_input", # Should not loop back directly, get input first
+             END: END
+        }
+    )
 
-graph_builder.add_conditional_edges(
-    "get_input", # Source node for routing decisions *after* getting user input
-    route_logic,
-    {
-        "evaluate_quiz": "evaluate_quiz",
-        "chatbot_node": "chatbot_node", # Route to chatbot to process command/chat
-         END: END # Should not happen here unless user types quit command directly
-    }
-)
+    graph_builder.add_conditional_edges(
+        "get_input", # Source node for routing decisions *after* getting user input
+        route_logic,
+        {
+            "evaluate_quiz": "evaluate_quiz",
+            "chatbot_node": "chatbot_node", # Route to chatbot to process command/chat
+             END: END # Should not happen here unless user types quit command directly
+        }
+    )
 
 
-# Edges from specific task nodes
-graph_builder.add_edge("tools", "chatbot_node")          # After tools run, chatbot processes the ToolMessage result
-graph_builder.add_edge("evaluate_quiz", "generate_question") # After evaluating, generate the next question
-graph_builder.add_edge("generate_question", "get_input") # After generating, get user input (answer or command)
+    # Edges from specific task nodes
+    graph_builder.add_edge("tools", "chatbot_node")          # After tools run, chatbot processes the ToolMessage result
+    graph_builder.add_edge("evaluate_quiz", "generate_question") # After evaluating, generate the next question
+    graph_builder.add_edge("generate_question", "get_input") # After generating, get user input (answer or command)
 
-# Compile the graph
-try:
-    app = graph_builder.compile()
-except Exception as e:
-    print(f"Error compiling graph: {e}")
-    app = None # Set app to None if compilation fails
+    return graph_builder.compile(checkpointer=checkpointer)
 
+@shared
+def get_app():
+    """The compiled, checkpointed graph shared by every session"""
+    return build_graph(checkpointer=get_checkpointer())
 
-if app:
-    print("\nStarting Idiomatic Chatbot...")
-    # Load initial data
-    user_data = load_user_data()
-    fields_to_save = ["name", "score", "history", "repetition_schedule"]
-    initial_state = IdiomaticState(
+def new_session_state() -> IdiomaticState:
+    """Blank state for a new session, user data is loaded once the user tells us their name during setup"""
+    user_data = new_user_data()
+    return IdiomaticState(
         messages=[], # Start with empty messages for the graph
-        name=user_data.get("name", ""),
-        user_level=user_data.get("user_level", ""),
-        category=user_data.get("category", "general"),
-        score=user_data.get("score", 0),
-        history=user_data.get("history", []),
-        repetition_schedule=user_data.get("repetition_schedule", {}),
+        name=user_data["name"],
+        user_level=user_data["user_level"],
+        category=user_data["category"],
+        score=user_data["score"],
+        history=[],
+        review_queue=[],
+        conversation_summary="",
+        summary_cursor="",
         finished=False,
         last_question=None # Initialize as None
     )
 
-    # Run the graph stream
-    try:
-        # Use stream method for interactive input/output
-        final_state = None
-        for event in app.stream(initial_state, {"recursion_limit": 100}):
-            # The stream automatically handles invoking nodes based on edges
-            # We primarily care about the final state or handling specific events if needed
-            # print(f"Graph Event: {event}") # For debugging graph flow
-            # Extract the latest state from the event if needed for saving
-                for key, value in event.items():
-                    # Check if the value is a dictionary (likely represents node output with state)
-                    if isinstance(value, dict) and 'messages' in value:
-                        final_state = value # Capture the latest state snapshot
-                        # Check if the 'finished' flag was set in this state update
-                        if final_state.get('finished'):
-                            print("--- Finishing Loop (detected finished flag) ---")
-                            break # Exit the loop if finished flag is set
-
-
-                if final_state and final_state.get('finished'):
-                    break # Ensure loop terminates if finished flag detected
 
 
+def shutdown_services():
+    """Stop background work and close the stores shared by all sessions"""
+    if get_question_pool.created():
+        pool = get_question_pool()
+        logger.debug("Question pool stats: %s", pool.stats())
+        pool.shutdown()
+        # Keep prefetched questions nobody got to for the next session
+        for (level, category), items in pool.drain().items():
+            get_question_bank().add_many(items, level, category)
+        get_question_pool.reset()
+    if get_response_cache.created():
+        logger.debug("Response cache stats: %s", get_response_cache().stats())
+        get_response_cache().close()
+        get_response_cache.reset()
+    if get_governor.created():
+        logger.debug("Model governor stats: %s", get_governor().stats())
+    if get_checkpointer.created():
+        if isinstance(get_checkpointer(), SqliteCheckpointer):
+            logger.debug("Checkpoint stats: %s", get_checkpointer().stats())
+            get_checkpointer().close()
+        get_checkpointer.reset()
+        get_app.reset()
+    for getter in (get_question_bank, get_user_store, get_span_exporter, get_answer_log):
+        if getter.created() and getter() is not None:
+            getter().close()
+        getter.reset()
+    if METRICS_FILE:
+        with open(METRICS_FILE, "w") as file:
+            file.write(metrics.render_prometheus())
+
+TERMINAL_SESSION = os.getenv('IDIOMATIC_SESSION', 'terminal')  # checkpoint thread of the terminal/notebook session
+
+def pending_prompt(snapshot):
+    """The prompt of the read_input() a checkpointed session is waiting on, or None"""
+    interrupts = [item for task in snapshot.tasks for item in task.interrupts]
+    return interrupts[0].value if interrupts else None
+
+def run_terminal_session(app):
+    """Drive one interactive session on stdin/stdout, resuming the last one if it didn't finish"""
+    print("\nStarting Idiomatic Chatbot...")
+    config = {"configurable": {"thread_id": TERMINAL_SESSION}, "recursion_limit": 100}
+    snapshot = app.get_state(config)
+    # A node waiting on its second read_input() shows up as an interrupted task but not in `next`
+    if snapshot.next or pending_prompt(snapshot) is not None:
+        # The previous session stopped mid-way, carry on from its last checkpoint
+        print("Resuming your previous session...")
+        graph_input = None
+        if snapshot.values.get("last_question"):
+            render(snapshot.values["last_question"]["question"])
+    else:
+        graph_input = new_session_state()
+
+    # Run the graph one reply at a time
+    final_state = None
+    try:
+        while True:
+            if graph_input is None:
+                snapshot = app.get_state(config)
+                prompt = pending_prompt(snapshot)
+                if prompt is None and not snapshot.next:
+                    break
+                if prompt is not None:
+                    graph_input = Command(resume=input(prompt))
+            # Each event is the full state after a node, nodes only hand back what they changed
+            for final_state in app.stream(graph_input, config, stream_mode="values"):
+                pass
+            if final_state and final_state.get('finished'):
+                logger.debug("Finishing Loop (detected finished flag)")
+                break
+            graph_input = None
+
         print("\nSession Ended.")
-        # Save final state if available
-        if final_state:
+        # Answers and schedule entries are saved as they happen, only the profile is left
+        if final_state and final_state.get("name"):
                 print("Saving final user data...")
-                save_user_data({k:v for k, v in final_state.items() if k in fields_to_save})
-        else:
-                # If loop ended without final state, try saving initial (might have been modified)
-                print("Saving user data (final state not captured)...")
-                save_user_data({k:v for k, v in initial_state.items() if k in fields_to_save})
+                get_user_store().save_profile(final_state)
+        app.checkpointer.delete_thread(TERMINAL_SESSION)
 
 
     except Exception as e:
         print(f"\nAn error occurred during the chat session: {e}")
         # Attempt to save current state on error
-        print("Attempting to save current user data on error...")
-        # If final_state has data, save it, otherwise save the initial_state which might have been updated
-        save_user_data({k:v for k, v in final_state.items() if k in fields_to_save} if final_state else initial_state)
+        if final_state and final_state.get("name"):
+            print("Attempting to save current user data on error...")
+            get_user_store().save_profile(final_state)
+        print("Run Idiomatic again to pick up where you left off.")
     finally:
+            shutdown_services()
             print("Idiomatic chatbot finished.")
 
-else:
-    print("Graph compilation failed. Cannot run the application.")
\ No newline at end of file
+
+## Bulk Question Builder
+
+"""
+`python idiomatic.py build` fills the question bank ahead of time, so the live service can run
+almost entirely from precomputed questions. Every level x category slice is topped up to
+`--per-slice` questions with batched calls (`generate_quiz_items`, so the same prompt, config,
+validation and rate limiting as the prefetch pool) on a bounded worker pool. Items are deduped
+by near-duplicate idiom within each slice and written as each batch comes back, either into a
+question bank (SQLite) or appended to a `.jsonl` file. Rerunning picks up where an interrupted
+build stopped: slices only get what they are still missing.
+"""
+
+BUILD_LEVELS = ("beginner", "intermediate", "advanced")
+BUILD_WORKERS = int(os.getenv('IDIOMATIC_BUILD_WORKERS', 4))
+BUILD_MAX_BATCHES = 3  # batches per slice, as a multiple of the batches it needs, before giving up on it
+
+class JsonlQuestionWriter:
+    """Appends built quiz items to a JSONL file, deduplicated through an in-memory question bank"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._index = QuestionBank(":memory:")
+        if os.path.exists(path):
+            # Resuming: drop a line cut short by a crash and index what earlier runs wrote
+            with open(path, "rb+") as file:
+                data = file.read()
+                file.truncate(data.rfind(b"\n") + 1)
+            for line in data[:data.rfind(b"\n") + 1].splitlines():
+                record = json.loads(line)
+                self._index.add(record, record["level"], record["category"])
+        self._file = open(path, "a")
+
+    def count(self, level: str, category: str) -> int:
+        return self._index.count(level, category)
+
+    def recent_idioms(self, level: str, category: str, limit: int) -> list[str]:
+        return self._index.recent_idioms(level, category, limit)
+
+    def add_many(self, items, level: str, category: str) -> int:
+        added = [item for item in items if self._index.add(item, level, category)]
+        for item in added:
+            self._file.write(json.dumps({**item, "level": level, "category": category}) + "\n")
+        self._file.flush()
+        return len(added)
+
+    def close(self):
+        self._file.close()
+        self._index.close()
+
+def build_question_bank(levels, categories, per_slice: int, output=QUESTION_BANK_PATH, workers=BUILD_WORKERS,
+                        batch_size=GENERATE_QnA_BATCH_SIZE) -> dict:
+    """Top up every level x category slice of `output` to `per_slice` questions, returns per-slice stats"""
+    store = JsonlQuestionWriter(output) if output.endswith(".jsonl") else QuestionBank(output)
+    slices = {
+        (level, category): {"existing": store.count(level, category), "added": 0, "duplicates": 0, "batches": 0, "errors": 0}
+        for level in levels for category in categories
+    }
+    max_batches = BUILD_MAX_BATCHES * -(-per_slice // batch_size)
+    pending = {}  # future -> (level, category)
+
+    def missing(key) -> int:
+        # Batches still in flight count as if they'll come back full
+        in_flight = batch_size * sum(1 for other in pending.values() if other == key)
+        return per_slice - slices[key]["existing"] - slices[key]["added"] - in_flight
+
+    def submit_batches(executor):
+        # Round-robin over the slices, so every slice makes progress from the start
+        while len(pending) < workers:
+            open_slices = [key for key in slices if missing(key) > 0 and slices[key]["batches"] < max_batches]
+            if not open_slices:
+                return
+            for key in sorted(open_slices, key=missing, reverse=True)[:workers - len(pending)]:
+                slices[key]["batches"] += 1
+                pending[executor.submit(
+                    generate_quiz_items, *key, min(batch_size, missing(key)), store.recent_idioms(*key, PROMPT_AVOID_IDIOMS)
+                )] = key
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="idiomatic-build") as executor:
+            submit_batches(executor)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key = pending.pop(future)
+                    try:
+                        items = future.result()
+                    except Exception as e:
+                        logger.warning("Batch for %s/%s failed: %s", *key, e)
+                        slices[key]["errors"] += 1
+                        continue
+                    # Beyond what the slice still needs, items are left for another run rather than stored
+                    items = items[:max(per_slice - slices[key]["existing"] - slices[key]["added"], 0)]
+                    added = store.add_many(items, *key)
+                    slices[key]["added"] += added
+                    slices[key]["duplicates"] += len(items) - added  # near-duplicates of stored questions
+                    metrics.inc("idiomatic_bank_build_items_total", added, level=key[0], category=key[1])
+                    logger.info("%s/%s: %s of %s questions", *key, slices[key]["existing"] + slices[key]["added"], per_slice)
+                submit_batches(executor)
+    finally:
+        store.close()
+    return {f"{level}/{category}": stats for (level, category), stats in slices.items()}
+
+
+## Server Mode
+
+"""
+`python idiomatic.py serve` runs many sessions concurrently in one process. All sessions share
+one graph compiled with a checkpointer; each session is a checkpointer thread, and is driven with
+`ainvoke`. Where the terminal version prompts on stdin at each LangGraph interrupt, a server
+session stops there and resumes with the learner's next message. Whatever the nodes render along the way
+is returned in the response.
+
+The API is plain JSON over HTTP:
+    POST   /sessions                   start a session
+    POST   /sessions/<id>/input        {"text": "..."}, send the learner's next message
+                                       ({"text": "...", "stream": true} streams it, see below)
+    DELETE /sessions/<id>              end a session
+    GET    /stats                      session count and pool/cache stats
+    GET    /metrics                    Prometheus metrics (see Instrumentation)
+Each session response is {"session_id", "output": [markdown, ...], "prompt", "finished"}.
+A streamed response is chunked NDJSON: {"type": "delta", "item", "text"} events as a reply is
+generated and {"type": "render", "item", "markdown"} for other output, where `item` is the
+index in `output`, then the usual response as {"type": "done", ...}.
+
+To exercise the server locally without calling Gemini, pass stub models to `set_models` first.
+"""
+
+SERVER_HOST = os.getenv('IDIOMATIC_HOST', '127.0.0.1')
+SERVER_PORT = int(os.getenv('IDIOMATIC_PORT', 8000))
+SERVER_THREADS = int(os.getenv('IDIOMATIC_SERVER_THREADS', 64))        # threads running (blocking) graph nodes
+SERVER_MAX_SESSIONS = int(os.getenv('IDIOMATIC_MAX_SESSIONS', 1000))
+SERVER_SESSION_TTL = float(os.getenv('IDIOMATIC_SESSION_TTL', 30 * 60))  # seconds a session may sit idle
+
+@dataclass
+class Session:
+    """A learner's session in server mode"""
+    id: str
+    sink: BufferSink
+    lock: asyncio.Lock
+    last_active: float
+
+class SessionManager:
+    """Runs concurrent sessions against one checkpointed graph"""
+
+    def __init__(self, graph, max_sessions=SERVER_MAX_SESSIONS, session_ttl=SERVER_SESSION_TTL, callbacks=None):
+        self.graph = graph  # compiled with a checkpointer
+        self.max_sessions = max_sessions
+        self.session_ttl = session_ttl
+        self.callbacks = callbacks or []  # LangChain callback handlers attached to every run
+        self.sessions = {}
+
+    def _config(self, session: Session) -> dict:
+        return {"configurable": {"thread_id": session.id}, "recursion_limit": 100, "callbacks": self.callbacks}
+
+    async def start(self) -> dict:
+        if len(self.sessions) >= self.max_sessions:
+            self.expire_idle()
+            if len(self.sessions) >= self.max_sessions:
+                raise OverflowError("Too many active sessions")
+        session = Session(id=uuid.uuid4().hex, sink=BufferSink(), lock=asyncio.Lock(), last_active=time.monotonic())
+        self.sessions[session.id] = session
+        return await self._run(session, new_session_state())
+
+    def _session(self, session_id: str) -> Session:
+        """A live session, or one restored from its checkpoint after a restart (KeyError if neither exists)"""
+        if session_id not in self.sessions:
+            if self.graph.checkpointer.get_tuple({"configurable": {"thread_id": session_id}}) is None:
+                raise KeyError(session_id)
+            logger.debug("Restoring Session %s", session_id)
+            self.sessions[session_id] = Session(
+                id=session_id, sink=BufferSink(), lock=asyncio.Lock(), last_active=time.monotonic()
+            )
+        return self.sessions[session_id]
+
+    async def send(self, session_id: str, text: str) -> dict:
+        """Resume a session with the learner's message (KeyError if the session doesn't exist)"""
+        return await self._run(self._session(session_id), Command(resume=text))
+
+    def send_stream(self, session_id: str, text: str):
+        """Like `send`, but returns an async iterator of output events ending with the response"""
+        session = self._session(session_id)
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        # Nodes run on executor threads, hand their events over to the loop
+        listener = lambda event: loop.call_soon_threadsafe(events.put_nowait, event)
+        run = asyncio.ensure_future(self._run(session, Command(resume=text), listener))
+        run.add_done_callback(lambda _: events.put_nowait(None))
+
+        async def stream():
+            while (event := await events.get()) is not None:
+                yield event
+            yield {"type": "done", **run.result()}
+        return stream()
+
+    async def _run(self, session: Session, graph_input, listener=None) -> dict:
+        async with session.lock:
+            session.last_active = time.monotonic()
+            session.sink.listener = listener
+            token = current_session.set(session)
+            try:
+                await self.graph.ainvoke(graph_input, self._config(session))
+            except Exception as e:
+                logger.error("Error in session %s: %s", session.id, e)
+                session.sink.render("Sorry, I encountered an error. Please try again.")
+            finally:
+                current_session.reset(token)
+                session.sink.listener = None
+            snapshot = await self.graph.aget_state(self._config(session))
+            output = session.sink.drain()
+
+        prompt = pending_prompt(snapshot)
+        finished = not snapshot.next and prompt is None
+        if finished:
+            self.end(session.id)
+        return {
+            "session_id": session.id,
+            "output": output,
+            "prompt": prompt,
+            "finished": finished,
+        }
+
+    def end(self, session_id: str):
+        self.sessions.pop(session_id)
+        self.graph.checkpointer.delete_thread(session_id)
+
+    def expire_idle(self):
+        cutoff = time.monotonic() - self.session_ttl
+        for session_id in [sid for sid, session in self.sessions.items() if session.last_active < cutoff]:
+            logger.debug("Expiring Idle Session %s", session_id)
+            self.end(session_id)
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self.sessions),
+            "question_pool": get_question_pool().stats(),
+            "response_cache": get_response_cache().stats(),
+            "model_governor": get_governor().stats(),
+            "question_validation": quiz_item_stats(),
+            "answer_log": get_answer_log().stats() if get_answer_log() is not None else {},
+            "checkpoints": self.graph.checkpointer.stats() if isinstance(self.graph.checkpointer, SqliteCheckpointer) else {},
+        }
+
+HTTP_REASONS = {
+    200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+    500: "Internal Server Error", 503: "Service Unavailable",
+}
+
+async def handle_http(manager: SessionManager, reader, writer):
+    """Serve a single HTTP/1.1 request on the connection, then close it"""
+    try:
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            status, payload = await route_request(manager, *request_line[:2], body)
+        except (ValueError, TypeError, asyncio.IncompleteReadError) as e:
+            status, payload = 400, {"error": str(e)}
+        except Exception:
+            logger.exception("Error handling a request")
+            status, payload = 500, {"error": "internal server error"}
+
+        if hasattr(payload, "__aiter__"):
+            await write_ndjson_stream(writer, status, payload)
+            return
+        if isinstance(payload, str):
+            data, content_type = payload.encode(), "text/plain; version=0.0.4"
+        else:
+            data, content_type = json.dumps(payload).encode(), "application/json"
+        writer.write(
+            f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def write_ndjson_stream(writer, status: int, events):
+    """Send each event as a JSON line in its own HTTP chunk as soon as it is produced"""
+    writer.write(
+        f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\nContent-Type: application/x-ndjson\r\n"
+        f"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n".encode()
+    )
+    try:
+        async for event in events:
+            line = json.dumps(event).encode() + b"\n"
+            writer.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+    except ConnectionError as e:
+        logger.debug("Client went away mid-stream: %s", e)
+    finally:
+        writer.close()
+
+async def route_request(manager: SessionManager, method: str, path: str, body: bytes):
+    parts = path.strip("/").split("/")
+    try:
+        if parts == ["stats"] and method == "GET":
+            return 200, manager.stats()
+        if parts == ["metrics"] and method == "GET":
+            return 200, metrics.render_prometheus()
+        if parts == ["sessions"] and method == "POST":
+            return 200, await manager.start()
+        if len(parts) == 3 and parts[0] == "sessions" and parts[2] == "input" and method == "POST":
+            request = json.loads(body or b"{}")
+            text = request.get("text") if isinstance(request, dict) else None
+            if not isinstance(text, str):
+                return 400, {"error": "expected a JSON body with a 'text' string"}
+            if request.get("stream"):
+                return 200, manager.send_stream(parts[1], text)
+            return 200, await manager.send(parts[1], text)
+        if len(parts) == 2 and parts[0] == "sessions" and method == "DELETE":
+            manager.end(parts[1])
+            return 200, {"session_id": parts[1], "finished": True}
+    except KeyError:
+        return 404, {"error": "unknown session"}
+    except OverflowError as e:
+        return 503, {"error": str(e)}
+    if parts[0] in ("sessions", "stats", "metrics"):
+        return 405, {"error": f"{method} not allowed on {path}"}
+    return 404, {"error": f"no route for {path}"}
+
+async def serve(host=SERVER_HOST, port=SERVER_PORT):
+    """Run the multi-session HTTP server until cancelled"""
+    # Nodes are synchronous, ainvoke runs them on the loop's default executor
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=SERVER_THREADS, thread_name_prefix="idiomatic-node")
+    )
+    manager = SessionManager(get_app())
+    server = await asyncio.start_server(lambda r, w: handle_http(manager, r, w), host, port)
+    print(f"Idiomatic server listening on http://{host}:{port}")
+
+    async def expire_sessions():
+        while True:
+            await asyncio.sleep(60)
+            manager.expire_idle()
+
+    expiry = asyncio.create_task(expire_sessions())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        expiry.cancel()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Idiomatic, an English idiom tutor")
+    commands = parser.add_subparsers(dest="command")
+    serve_parser = commands.add_parser("serve", help="run the multi-session HTTP server")
+    serve_parser.add_argument("--host", default=SERVER_HOST)
+    serve_parser.add_argument("--port", type=int, default=SERVER_PORT)
+    build_parser = commands.add_parser("build", help="pre-generate questions for a matrix of levels x categories")
+    build_parser.add_argument("--levels", nargs="+", default=list(BUILD_LEVELS))
+    build_parser.add_argument("--categories", nargs="+", default=["general"])
+    build_parser.add_argument("--per-slice", type=int, default=50, help="questions wanted per level/category")
+    build_parser.add_argument("--workers", type=int, default=BUILD_WORKERS, help="batches generated in parallel")
+    build_parser.add_argument("--batch-size", type=int, default=GENERATE_QnA_BATCH_SIZE, help="questions per model call")
+    build_parser.add_argument("--output", default=QUESTION_BANK_PATH, help="question bank database, or a .jsonl file")
+    analytics_parser = commands.add_parser("analytics", help="print answer statistics across all users")
+    analytics_parser.add_argument("--since-days", type=float, help="only answers from the last N days")
+    analytics_parser.add_argument("--top", type=int, default=20, help="hardest idioms listed")
+    analytics_parser.add_argument("--min-answers", type=int, default=5, help="answers an idiom needs to be ranked")
+    analytics_parser.add_argument("--rebuild", action="store_true", help="refill the answer log from the user store first")
+    if argv is None and in_notebook():
+        argv = []  # sys.argv holds the kernel's own arguments
+    args = parser.parse_args(argv)
+    # The debug trail is on by default in the terminal and off in the server
+    configure_logging(os.getenv('IDIOMATIC_DEBUG', '0' if args.command in ("serve", "build", "analytics") else '1') == '1')
+
+    if args.command == "analytics":
+        log = get_answer_log()
+        if log is None:
+            print("The answer log is disabled (IDIOMATIC_ANSWER_LOG is empty).")
+            return
+        try:
+            if args.rebuild:
+                store = get_user_store()
+                if not store.keeps_answer_history:
+                    print("The user store backend doesn't keep an answer history to rebuild from.")
+                    return
+                print(f"Rebuilt the answer log from {rebuild_answer_log(log, store)} recorded answers.")
+            since = time.time() - args.since_days * 86400 if args.since_days is not None else None
+            print(json.dumps(log.report(since, args.top, args.min_answers), indent=2))
+        finally:
+            shutdown_services()
+        return
+
+    if args.command == "build":
+        try:
+            report = build_question_bank(
+                args.levels, args.categories, args.per_slice, args.output, args.workers, args.batch_size
+            )
+        except KeyboardInterrupt:
+            print("Interrupted, run the same command again to resume.")
+            return
+        finally:
+            shutdown_services()
+        print(f"\n{'slice':<32}{'existing':>10}{'added':>8}{'duplicates':>12}{'errors':>8}")
+        for name, stats in report.items():
+            print(f"{name:<32}{stats['existing']:>10}{stats['added']:>8}{stats['duplicates']:>12}{stats['errors']:>8}")
+        return
+
+    if args.command == "serve":
+        try:
+            asyncio.run(serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            shutdown_services()
+        return
+
+    try:
+        app = get_app()
+    except Exception as e:
+        print(f"Error compiling graph: {e}")
+        print("Graph compilation failed. Cannot run the application.")
+        return
+    run_terminal_session(app)
+
+
+if __name__ == "__main__":
+    main()